@@ -1,13 +1,23 @@
-from json import load
 from dotenv import load_dotenv
 import rasterio
 from image_handling import transform_panorama, verify_viewpoint
-from location_handler import find_visible_items_in_ds
+from json import dumps, load
+import cv2
+import numpy as np
+from affine import Affine
+from rasterio.transform import rowcol
+from location_handler import find_visible_items_in_ds, get_raster_data, get_raster_path
 from map_plotting import plot_to_map
-from renderer import generate_viewshed, render_height
-from tools.debug import p_e
+from povs import primary_pov
+from renderer import execute_pov, generate_viewshed, get_lod, position_camera, render_height
+from tools.debug import p_e, p_i, p_s
+from tools.heightfield_lod import compare_skylines
+from tools.horizon import compute_horizon, horizon_visible
 from tools.file_handling import get_mountain_data, load_image_data, read_image_locations, read_mountain_gpx
-from tools.types import CrsToLatLng, LatLngToCrs
+from tools.raster import open_raster
+from tools.types import get_crs_to_latlng, get_latlng_to_crs
+from tools.viewshed import compute_viewshed, get_viewshed_path, open_viewshed
+from tools.workspace import scratch_workspace
 from vistools.tplot import plot_3d
 from os import getenv
 
@@ -17,11 +27,7 @@ def debugger(mode):
     if mode == 0:
         img_filename = getenv("DEBUG_IMAGE_FILENAME")
         img_data = load_image_data(img_filename)
-        render_settings_path = "render_settings.json"
-        with open(render_settings_path) as json_file:
-            data = load(json_file)
-            dem_path = data["dem_path"]
-            json_file.close()
+        dem_path = get_raster_path()
         dem_path, _, _ = get_mountain_data(
             dem_path, img_data, True
         )
@@ -31,26 +37,21 @@ def debugger(mode):
     elif mode == 1:
         img_filename = getenv("DEBUG_IMAGE_FILENAME")
         img_data = load_image_data(img_filename)
-        render_settings_path = "render_settings.json"
-        with open(render_settings_path) as json_file:
-            data = load(json_file)
-            dem_path = data["dem_path"]
-            json_file.close()
+        dem_path = get_raster_path()
         dem_path, coordinates, _ = get_mountain_data(
             dem_path, img_data, True
         )
-        ds_raster = rasterio.open(dem_path)
-        crs = int(ds_raster.crs.to_authority()[1])
-        converter = LatLngToCrs(crs)
-        viewshed = f'{img_data.folder}/viewshed.tif'
-        ds_viewshed = rasterio.open(viewshed)
+        ds_raster = open_raster(dem_path)
+        crs = ds_raster.crs
+        converter = get_latlng_to_crs(crs)
+        ds_viewshed = open_viewshed(get_viewshed_path(img_data.folder))
         gpx_file = getenv("DEBUG_GPX_FILE")
         mountains = read_mountain_gpx(gpx_file, converter)
-        mountains_in_sight = find_visible_items_in_ds(
-            ds_viewshed, mountains)
+        mountains_in_sight = [mountains[i] for i in find_visible_items_in_ds(
+            ds_viewshed, mountains)]
         plot_filename = f"{img_data.folder}/{img_data.filename}-{gpx_file.split('/')[-1].split('.')[0]}.html"
         images = read_image_locations(
-            img_data.filename, "src/static/images", ds_raster, converter
+            img_data.filename, "src/static/images", ds_raster
         )
         plot_to_map(
             img_data.thumbnail_path,
@@ -58,7 +59,7 @@ def debugger(mode):
             coordinates,
             plot_filename,
             dem_path,
-            CrsToLatLng(crs),
+            get_crs_to_latlng(crs),
             mountains=mountains,
             images=images,
         )
@@ -82,5 +83,78 @@ def debugger(mode):
         img_filename = getenv("DEBUG_IMAGE_FILENAME")
         img_data = load_image_data(img_filename)
         print(verify_viewpoint(img_data.render_path))
+    elif mode == 6:
+        # the skyline of the level of detail height field against the full
+        # resolution crop, they should stay within a pixel of each other
+        img_filename = getenv("DEBUG_IMAGE_FILENAME")
+        img_data = load_image_data(img_filename)
+        with open("render_settings.json") as json_file:
+            settings = {**load(json_file), "lod_heightfield": True}
+        r_h = settings["render_height"]
+        dimensions = [r_h * 2, r_h]
+        cropped_dem, coordinates, _ = get_mountain_data(
+            get_raster_path(), img_data)
+        raster_data, _, camera_height = get_raster_data(
+            open_raster(cropped_dem), coordinates, 3.0)
+        # from the same viewpoint as the renders
+        position_camera(cropped_dem, raster_data, 3.0, camera_height,
+                        settings.get("render_backend", "povray"))
+        with scratch_workspace() as workspace:
+            lod = get_lod(cropped_dem, raster_data, dimensions, settings, workspace)
+            if not lod:
+                p_i("The crop is rendered at full resolution at this size")
+                return
+            renders = []
+            for levels, name in ((None, "full"), (lod, "lod")):
+                out_filename = f"{workspace}/{name}.png"
+                pov_filename = f"{workspace}/{name}.pov"
+                with open(pov_filename, "w") as pf:
+                    pf.write(primary_pov(cropped_dem, raster_data, 3.0,
+                                         mode="coordinates", lod=levels))
+                execute_pov([pov_filename, out_filename, dimensions, "coordinates"])
+                renders.append(cv2.imread(out_filename, cv2.IMREAD_UNCHANGED))
+        shift = compare_skylines(*renders)
+        if shift > 1:
+            p_e(f"Skylines differ by {shift} pixels with {len(lod)} levels")
+        else:
+            p_s(f"Skylines within {shift} pixel with {len(lod)} levels")
+            # verified against povray, renders use the nested height fields
+            # from now on
+            with open("render_settings.json") as json_file:
+                stored_settings = load(json_file)
+            if not stored_settings.get("lod_heightfield", False):
+                stored_settings["lod_heightfield"] = True
+                with open("render_settings.json", "w") as json_file:
+                    json_file.write(dumps(stored_settings, indent=4) + "\n")
+                p_i("Turned on lod_heightfield in render_settings.json")
+    elif mode == 7:
+        # terrain between two horizon rings hides a target in front of a
+        # higher skyline, the horizon must agree with the viewshed
+        hidden, seen = check_horizon_occluder()
+        if hidden and seen:
+            p_s("Horizon agrees with the viewshed around the occluder")
+        else:
+            p_e("Horizon and viewshed disagree around the occluder")
     else:
         p_e("Mode not recognized")
+
+
+def check_horizon_occluder(cell=50.0, size=900):
+    # flat synthetic dem, a 300 m wall at 9850 m, a 50 m target at 10100 m
+    # and a 2000 m ridge at 15 km as the skyline, the wall and the target
+    # sit between the same two rings
+    band = np.zeros((size, size), dtype=np.float32)
+    transform = Affine(cell, 0, 0, 0, -cell, size * cell)
+    x, y = size * cell / 2 + cell / 2, size * cell / 2 - cell / 2
+    for distance, height in ((9850, 300), (10100, 50), (15000, 2000)):
+        band[int((size * cell - y - distance) // cell), :] = height
+    target_x, target_y = x, y + 10100
+    target_row, target_col = (int(v) for v in rowcol(transform, target_x, target_y))
+    viewshed = compute_viewshed(band, transform, None, x, y)
+    horizon = compute_horizon(band, transform, None, x, y)
+    target_seen = horizon_visible(
+        horizon, band, transform, None, [target_x], [target_y], [50.0])[0]
+    # and one towering above the wall is seen
+    tower_seen = horizon_visible(
+        horizon, band, transform, None, [target_x], [target_y], [800.0])[0]
+    return not target_seen and not viewshed[target_row, target_col], bool(tower_seen)
@@ -10,6 +10,7 @@ from tools.debug import custom_imshow, p_i, p_in
 from datetime import datetime
 from tkinter.filedialog import askdirectory
 from tools.types import Location
+from tools.workspace import move_file, scratch_workspace
 from piexif import transplant
 import exif
 
@@ -60,10 +61,12 @@ def write_exif_to_pano(file_path, fov):
         image_file.close()
     im.gps_img_direction = get_view_direction(fov)
     im.gps_img_direction_ref = "M"
-    with open("/tmp/exifed.jpg", "wb") as new_image_file:
-        new_image_file.write(im.get_file())
-        new_image_file.close()
-    os.rename("/tmp/exifed.jpg", file_path)
+    with scratch_workspace() as workspace:
+        exifed_pano = f"{workspace}/exifed.jpg"
+        with open(exifed_pano, "wb") as new_image_file:
+            new_image_file.write(im.get_file())
+            new_image_file.close()
+        move_file(exifed_pano, file_path)
 
 
 def vertical_stack_imshow_divider(im1, im2, title="Preview", div_thickness=3):
@@ -251,11 +254,12 @@ def reduce_filesize(image_path, image_quality=50):
         n_w = 16000
         n_h = int(n_w / width * height)
         im = im.resize((n_w, n_h), Image.ANTIALIAS)
-    resized_pano = "/tmp/resized.jpg"
-    im.save(resized_pano, quality=image_quality, optimize=True)
-    transplant(image_path, resized_pano)
-    os.remove(image_path)
-    os.rename(resized_pano, image_path)
+    with scratch_workspace() as workspace:
+        resized_pano = f"{workspace}/resized.jpg"
+        im.save(resized_pano, quality=image_quality, optimize=True)
+        transplant(image_path, resized_pano)
+        os.remove(image_path)
+        move_file(resized_pano, image_path)
 
 
 def matching(img_data):
@@ -371,6 +375,9 @@ def transform_panorama(
     cv2.imwrite(IMAGE_DATA.thumbnail_path,
                 resizer(panorama_image, im_width=450))
 
+    IMAGE_DATA.render_bbox = [
+        minx, miny, maxx, maxy, render_width, render_image.shape[0]]
+
     fov = heading_bound_left, heading_bound_right
     IMAGE_DATA.fov_l = heading_bound_left
     IMAGE_DATA.fov_r = heading_bound_right
@@ -380,6 +387,39 @@ def transform_panorama(
     return IMAGE_DATA
 
 
+def overlay_crop_render(IMAGE_DATA):
+    # redo the overlay and ultrawide images from the cropped re-render,
+    # mapping the panorama into its pixel grid with the same homography
+    minx, miny, _, _, _, _ = IMAGE_DATA.render_bbox
+    miny = max(miny, 0)
+    scale = IMAGE_DATA.crop_scale
+    crop_render = cv2.imread(IMAGE_DATA.crop_render_path)
+    if crop_render is None:
+        return False
+    panorama_image = cv2.imread(IMAGE_DATA.path)
+    panorama_image[np.where((panorama_image == [0, 0, 0]).all(axis=2))] = [
+        1, 1, 1]
+
+    to_crop = np.array(
+        [[scale, 0, -minx * scale], [0, scale, -miny * scale], [0, 0, 1]])
+    transform_matrix = to_crop @ np.linalg.inv(IMAGE_DATA.transform_matrix)
+    warped_panorama = cv2.warpPerspective(
+        panorama_image,
+        transform_matrix,
+        (crop_render.shape[1], crop_render.shape[0]),
+        borderMode=cv2.BORDER_TRANSPARENT,
+    )
+    mask = np.where((warped_panorama == (0, 0, 0)).all(
+        axis=2), 0, 255).astype(np.uint8)
+    bg_render = cv2.bitwise_and(
+        crop_render, crop_render, mask=cv2.bitwise_not(mask))
+    fg_panorama = cv2.bitwise_and(warped_panorama, warped_panorama, mask=mask)
+
+    cv2.imwrite(IMAGE_DATA.overlay_path, cv2.add(bg_render, fg_panorama))
+    cv2.imwrite(IMAGE_DATA.ultrawide_path, crop_render)
+    return True
+
+
 def image_array_to_flask(im):
     file_object = io.BytesIO()
     img = Image.fromarray(cv2.cvtColor(im, cv2.COLOR_BGR2RGB).astype("uint8"))
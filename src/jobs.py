@@ -0,0 +1,194 @@
+import atexit
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+import uuid
+from tools.debug import p_e, p_i
+
+JOBS_DB_PATH = "data/jobs.db"
+
+# module holding the functions jobs are dispatched to, looked up by name in
+# the worker so the queue never has to import the flask app
+TASK_MODULE = "tasks"
+
+
+def connect(db_path=JOBS_DB_PATH):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            task TEXT NOT NULL,
+            args TEXT NOT NULL,
+            status TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            worker INTEGER,
+            available REAL
+        )"""
+    )
+    return db
+
+
+def enqueue(task, db_path=JOBS_DB_PATH, **kwargs):
+    job_id = uuid.uuid4().hex
+    db = connect(db_path)
+    db.execute(
+        "INSERT INTO jobs (id, task, args, status, created) VALUES (?, ?, ?, ?, ?)",
+        (job_id, task, json.dumps(kwargs), "queued", time.time()),
+    )
+    db.close()
+    p_i(f"Queued {task} job {job_id}")
+    return job_id
+
+
+def get_job(job_id, db_path=JOBS_DB_PATH):
+    db = connect(db_path)
+    row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    db.close()
+    if row is None:
+        return None
+    return {
+        "id": row["id"],
+        "task": row["task"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+    }
+
+
+def set_progress(job_id, progress, db_path=JOBS_DB_PATH):
+    db = connect(db_path)
+    db.execute(
+        "UPDATE jobs SET progress = ? WHERE id = ?", (float(progress), job_id))
+    db.close()
+
+
+class Requeue(Exception):
+    # raised by a task that has to wait for another job, the job goes back
+    # to the queue for delay seconds instead of keeping its worker busy
+    def __init__(self, delay=2.0):
+        super().__init__(f"requeued for {delay} seconds")
+        self.delay = delay
+
+
+def claim_job(db):
+    # take the oldest queued job, the immediate transaction keeps two
+    # workers from claiming the same one
+    db.execute("BEGIN IMMEDIATE")
+    row = db.execute(
+        "SELECT * FROM jobs WHERE status = 'queued' "
+        "AND (available IS NULL OR available <= ?) ORDER BY created LIMIT 1",
+        (time.time(),),
+    ).fetchone()
+    if row is None:
+        db.execute("COMMIT")
+        return None
+    db.execute(
+        "UPDATE jobs SET status = 'running', started = ?, worker = ? WHERE id = ?",
+        (time.time(), os.getpid(), row["id"]),
+    )
+    db.execute("COMMIT")
+    return row
+
+
+def finish_job(db, job_id, result=None, error=None):
+    db.execute(
+        "UPDATE jobs SET status = ?, progress = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+        (
+            "failed" if error else "done",
+            100.0,
+            json.dumps(result),
+            error,
+            time.time(),
+            job_id,
+        ),
+    )
+
+
+def requeue_job(db, job_id, delay):
+    db.execute(
+        "UPDATE jobs SET status = 'queued', worker = NULL, available = ? WHERE id = ?",
+        (time.time() + delay, job_id),
+    )
+
+
+def work(db_path=JOBS_DB_PATH, poll_interval=0.5):
+    tasks = importlib.import_module(TASK_MODULE)
+    db = connect(db_path)
+    while True:
+        job = claim_job(db)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        p_i(f"Running {job['task']} job {job['id']}")
+        try:
+            task = getattr(tasks, job["task"])
+            result = task(job["id"], **json.loads(job["args"]))
+            finish_job(db, job["id"], result=result)
+        except Requeue as requeue:
+            requeue_job(db, job["id"], requeue.delay)
+        except Exception:
+            p_e(f"{job['task']} job {job['id']} failed")
+            finish_job(db, job["id"], error=traceback.format_exc())
+
+
+def worker_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue_orphaned_jobs(db_path=JOBS_DB_PATH):
+    # jobs whose worker died were interrupted, run them again. jobs of
+    # workers that are still alive, like those of another server, are theirs
+    db = connect(db_path)
+    db.execute("BEGIN IMMEDIATE")
+    running = db.execute(
+        "SELECT id, worker FROM jobs WHERE status = 'running'").fetchall()
+    orphaned = [row["id"] for row in running if not worker_alive(row["worker"])]
+    db.executemany(
+        "UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ?",
+        [(job_id,) for job_id in orphaned],
+    )
+    db.execute("COMMIT")
+    db.close()
+    return orphaned
+
+
+def start_workers(workers=0, db_path=JOBS_DB_PATH):
+    requeue_orphaned_jobs(db_path)
+    if workers <= 0:
+        workers = os.cpu_count()
+    processes = []
+    for _ in range(workers):
+        # not daemonic, tasks like the mountain lookup start their own workers
+        process = multiprocessing.Process(target=work, args=(db_path,))
+        process.start()
+        processes.append(process)
+    atexit.register(stop_workers, processes)
+    p_i(f"Started {workers} job workers")
+    return processes
+
+
+def stop_workers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
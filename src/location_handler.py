@@ -1,35 +1,48 @@
 from json import load
-from math import asin, atan2, pi, radians
-import os
-from subprocess import call
+from math import asin, atan2, pi
 import numpy as np
 import rasterio
 from tools.converters import (
+    HEIGHT_FIELD_OFFSET,
+    HEIGHT_FIELD_RANGE,
     convert_coordinates,
     get_earth_radius,
 )
 from tools.debug import p_a, p_e, p_s
+from tools.dem_tiles import ingest_dem_source
+from tools.raster import drop_nodata, open_raster
+from tools.horizon import compute_horizon, horizon_visible, save_horizon
+from tools.viewshed import (
+    CURVATURE_COEFFICIENT,
+    EARTH_DIAMETER,
+    VIEWSHED_MAX_DISTANCE,
+    compute_viewshed,
+    save_viewshed,
+)
 from numpy import arctan2, sin, cos, degrees
 import cv2
 from operator import attrgetter
-from tools.types import CrsToLatLng, Distance, LatLngToCrs, Location3D
+from tools.types import get_crs_to_latlng, get_latlng_to_crs
+
+# mean earth radius in meters, the one geopy great_circle uses
+GREAT_CIRCLE_RADIUS = 6371009.0
 
 
 def get_raster_data(ds_raster, coordinates, va):
-    crs = int(ds_raster.crs.to_authority()[1])
-    converter = LatLngToCrs(crs)
+    # ds_raster is a tools.raster.RasterAccessor
+    converter = get_latlng_to_crs(ds_raster.crs)
     camera_lat_lon = convert_coordinates(
         ds_raster, converter, coordinates[0], coordinates[1], va
     )
     if not camera_lat_lon:
         p_e("Camera location is out of bounds")
-        return
+        return None, None, None
     look_at_lat_lon = convert_coordinates(
         ds_raster, converter, coordinates[2], coordinates[3], va
     )
     if not look_at_lat_lon:
         p_e("Viewpoint location is out of bounds")
-        return
+        return None, None, None
     raster_left, raster_bottom, raster_right, raster_top = ds_raster.bounds
     total_distance_e_w = raster_right - raster_left
     total_distance_n_s = raster_top - raster_bottom
@@ -41,22 +54,45 @@ def get_raster_data(ds_raster, coordinates, va):
         pass
     normalized_coordinates = [*camera_lat_lon[:3], *look_at_lat_lon[:3]]
     raster_metadata = [distances, max_height]
-    return [normalized_coordinates, raster_metadata], camera_lat_lon[4]
+    camera_height = get_camera_clearance(
+        ds_raster, converter, coordinates[0], coordinates[1], va
+    )
+    return (
+        [normalized_coordinates, raster_metadata],
+        camera_lat_lon[4],
+        camera_height,
+    )
+
+
+def get_camera_clearance(ds_raster, converter, lat, lon, va, radius=2, clearance=2.0):
+    # lowest camera height in povray units that clears the heightfield
+    # within radius pixels of the camera, None if it can not be sampled
+    point = converter.convert(lat, lon)
+    neighbourhood = ds_raster.neighbourhood(point.GetX(), point.GetY(), radius)
+    if neighbourhood is None:
+        return None
+    neighbourhood = drop_nodata(neighbourhood, ds_raster.nodata)
+    if neighbourhood.size == 0:
+        return None
+    max_elevation = float(neighbourhood.max())
+    return ((max_elevation + clearance) / HEIGHT_FIELD_RANGE + HEIGHT_FIELD_OFFSET) * va
 
 
 def get_raster_path():
+    # the ingested copy of the configured dem, or a mosaic of the ingested
+    # tiles when dem_path is a folder or a list, see tools.dem_tiles
     render_settings_path = "render_settings.json"
     with open(render_settings_path) as json_file:
         data = load(json_file)
         dem_path = data["dem_path"]
-    return dem_path
+        cache_folder = data.get("dem_cache_path", "data/cache/dem")
+    return ingest_dem_source(dem_path, cache_folder)
 
 
-def get_height_from_raster(location, ds_raster, converter):
-    h = convert_coordinates(
-        ds_raster, converter, location.latitude, location.longitude, 1.0, get_height=True
-    )
-    return h
+def get_heights_from_raster(ds_raster, lats, lons, bilinear=False):
+    # ds_raster is a tools.raster.RasterAccessor, nan where there is no height
+    xs, ys = get_latlng_to_crs(ds_raster.crs).convert_many(lats, lons)
+    return ds_raster.sample_many(xs, ys, bilinear)
 
 
 def get_visible_coordinates(ds_raster, viewshed):
@@ -66,31 +102,53 @@ def get_visible_coordinates(ds_raster, viewshed):
     return [ds_raster.xy(*xy) for xy in coords if height_band[coords[0], coords[1]] > 25]
 
 
-def find_visible_items_in_ds(ds_viewshed, dataset):
-    if len(dataset) == 0:
-        return []
+def get_item_locations(dataset):
+    # the projected location2d of every item as x and y arrays, dataset may
+    # also be the locations already stacked in an n by 2 array
+    if isinstance(dataset, np.ndarray):
+        return dataset[:, 0].astype(np.float64), dataset[:, 1].astype(np.float64)
+    return np.array([i.location2d for i in dataset], dtype=np.float64).reshape(-1, 2).T
+
 
-    items_in_sight = set()
-    vs_val = ds_viewshed.read(1)
-
-    for i in dataset:
-        try:
-            for x in range(-1, 2):
-                for y in range(-1, 2):
-                    loc = i.location2d
-                    raster_coordinates = ds_viewshed.index(loc[0]+x, loc[1]+y)
-                    if vs_val[raster_coordinates] == 255:
-                        if i not in items_in_sight:
-                            items_in_sight.add(i)
-                        break
-        except IndexError:
-            continue
-
-    if len(items_in_sight) == 0:
+def report_items_in_sight(indices):
+    if len(indices) == 0:
         p_a("No items in sight")
     else:
-        p_s(f"Found a total of {len(items_in_sight)} items in sight")
-    return items_in_sight
+        p_s(f"Found a total of {len(indices)} items in sight")
+    return indices
+
+
+def find_visible_items_in_ds(ds_viewshed, dataset):
+    # ds_viewshed is a tools.viewshed.PackedViewshed. indices of the items
+    # in dataset with a visible cell among the 3x3 cells around them
+    if len(dataset) == 0:
+        return np.array([], dtype=np.int64)
+    xs, ys = get_item_locations(dataset)
+    cols, rows = ~ds_viewshed.transform * (xs, ys)
+    cols, rows = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+    visible = np.zeros(xs.shape, dtype=bool)
+    for x in range(-1, 2):
+        for y in range(-1, 2):
+            visible |= ds_viewshed.visible_cells(rows + y, cols + x)
+    return report_items_in_sight(np.flatnonzero(visible))
+
+
+def find_visible_items_in_horizon(horizon, ds_raster, dataset):
+    # horizon is a profile from create_horizon, ds_raster the crop it was
+    # made from. items are tested at the highest terrain of the 3x3 cells
+    # around them, like find_visible_items_in_ds
+    if len(dataset) == 0:
+        return np.array([], dtype=np.int64)
+    xs, ys = get_item_locations(dataset)
+    size_x, size_y = abs(ds_raster.transform.a), abs(ds_raster.transform.e)
+    heights = np.full(xs.shape, np.nan)
+    for x in range(-1, 2):
+        for y in range(-1, 2):
+            heights = np.fmax(heights, ds_raster.sample_many(
+                xs + x * size_x, ys + y * size_y))
+    visible = horizon_visible(
+        horizon, ds_raster.band, ds_raster.transform, ds_raster.nodata, xs, ys, heights)
+    return report_items_in_sight(np.flatnonzero(visible))
 
 
 def displace_camera(camera_lat, camera_lon, deg=0.0, dist=0.1):
@@ -122,17 +180,11 @@ def get_raster_bounds(dem_file, lat_lon=True):
     bounds = ds_raster.bounds
     crs = int(ds_raster.crs.to_authority()[1])
 
-    converter = CrsToLatLng(crs)
-
     if lat_lon:
-        ll = converter.convert(bounds.left, bounds.bottom)
-        lower_left = ll.latitude, ll.longitude
-        ul = converter.convert(bounds.left, bounds.top)
-        upper_left = ul.latitude, ul.longitude
-        ur = converter.convert(bounds.right, bounds.top)
-        upper_right = ur.latitude, ur.longitude
-        lr = converter.convert(bounds.right, bounds.bottom)
-        lower_right = lr.latitude, lr.longitude
+        lats, lons = get_crs_to_latlng(crs).convert_many(
+            [bounds.left, bounds.left, bounds.right, bounds.right],
+            [bounds.bottom, bounds.top, bounds.top, bounds.bottom])
+        lower_left, upper_left, upper_right, lower_right = zip(lats, lons)
     else:
         lower_left = (bounds.left, bounds.bottom)
         upper_left = (bounds.left, bounds.top)
@@ -182,55 +234,85 @@ def get_view_direction(fov):
     return ((left_bound + (fov_deg / 2)) + 180) % 360
 
 
-def get_3d_location(camera_location, dataset, fov):
+def get_3d_placements(camera_location, lats, lons, elevations, curvature=False):
+    # yaw, pitch and distance of every location seen from camera_location as
+    # one record array. distances are great circle distances like geopy, the
+    # camera sits 25 m above its elevation, and with curvature the targets
+    # sink below the horizontal like in the viewshed
+    c_lat = np.radians(camera_location.latitude)
+    c_lon = np.radians(camera_location.longitude)
+    o_lat = np.radians(np.asarray(lats, dtype=np.float64))
+    diff_lon = np.radians(np.asarray(lons, dtype=np.float64)) - c_lon
 
-    def get_initial_bearing(camera_location, object_location):
-        c_lon = radians(camera_location.longitude)
-        c_lat = radians(camera_location.latitude)
-        o_lon = radians(object_location.longitude)
-        o_lat = radians(object_location.latitude)
+    x = np.sin(diff_lon) * np.cos(o_lat)
+    y = np.cos(c_lat) * np.sin(o_lat) - np.sin(c_lat) * np.cos(o_lat) * np.cos(diff_lon)
+    yaws = np.degrees(np.arctan2(x, y)) % 360
 
-        diff_lon = o_lon - c_lon
+    haversine = (
+        np.sin((o_lat - c_lat) / 2) ** 2
+        + np.cos(c_lat) * np.cos(o_lat) * np.sin(diff_lon / 2) ** 2
+    )
+    distances = 2 * GREAT_CIRCLE_RADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
 
-        x = sin(diff_lon) * cos(o_lat)
-        y = cos(c_lat) * sin(o_lat) - sin(c_lat) * cos(o_lat) * cos(diff_lon)
+    diffs = np.asarray(elevations, dtype=np.float64) - (camera_location.elevation + 25)
+    if curvature:
+        diffs = diffs - CURVATURE_COEFFICIENT * distances ** 2 / EARTH_DIAMETER
+    pitches = np.degrees(np.arctan2(diffs, distances))
 
-        init_bearing = degrees(atan2(x, y))
-        compass_bearing = (init_bearing + 360) % 360
+    placements = np.rec.array(
+        np.empty(yaws.shape, dtype=[("yaw", np.float64), ("pitch", np.float64), ("distance", np.float64)]))
+    placements.yaw, placements.pitch, placements.distance = yaws, pitches, distances
+    return placements
 
-        return compass_bearing
 
-    def get_3d_placement(camera_location, item, generator):
-        d = generator.get_distance_between_locations(
-            camera_location, item.location)
-        c_e = camera_location.elevation + 25
-        i_e = item.location.elevation
-        diff = i_e - c_e
-        h = (d ** 2 + diff ** 2) ** 0.5
-        pitch = degrees(asin(diff / h))
-        yaw = get_initial_bearing(camera_location, item.location)
-        return yaw, pitch, d
+def in_fov(yaws, fov):
+    # fov is the left and right bound of the part of the panorama that is
+    # not covered, see get_fov_bounds
+    return (yaws < fov[0]) | (yaws > fov[1])
 
-    generator = Distance()
-    new_ds = []
-    for item in dataset:
-        yaw, pitch, d = get_3d_placement(
-            camera_location, item, generator
-        )
-        item.set_location_in_3d(Location3D(
-            yaw=yaw, pitch=pitch, distance=d))
-        if yaw < fov[0] or yaw > fov[1]:
-            new_ds.append(item)
 
+def get_3d_location(camera_location, dataset, fov, curvature=False):
+    # the items of dataset inside fov, each with its row of the placements
+    # from get_3d_placements as location_in_3d. items without an elevation
+    # can not be placed and are left out
+    if len(dataset) == 0:
+        return []
+    lats, lons, elevations = np.array([
+        (i.location.latitude, i.location.longitude,
+         np.nan if i.location.elevation is None else i.location.elevation)
+        for i in dataset
+    ], dtype=np.float64).T
+    placements = get_3d_placements(camera_location, lats, lons, elevations, curvature)
+    kept = np.flatnonzero(in_fov(placements.yaw, fov) & ~np.isnan(placements.pitch))
+    new_ds = []
+    for i in kept:
+        dataset[i].set_location_in_3d(placements[i])
+        new_ds.append(dataset[i])
     return new_ds
 
 
-def create_viewshed(dem_file, location, folder):
+def create_viewshed(dem_file, location, folder=None, observer_height=2.0, max_distance=VIEWSHED_MAX_DISTANCE):
+    # boolean grid of the dem cells visible from location, in the crs of
+    # dem_file, also saved to viewshed.npz in folder when given
+    ds_raster = open_raster(dem_file)
+    x, y = location
+    visible = compute_viewshed(
+        ds_raster.band, ds_raster.transform, ds_raster.nodata, x, y,
+        observer_height, max_distance=max_distance)
+    if visible is not None and folder:
+        save_viewshed(f"{folder}/viewshed.npz", visible,
+                      ds_raster.transform, ds_raster.crs)
+    return visible
+
+
+def create_horizon(dem_file, location, filename=None, observer_height=2.0, max_distance=VIEWSHED_MAX_DISTANCE):
+    # horizon profile of location, see tools.horizon, also saved to filename
+    # when given
+    ds_raster = open_raster(dem_file)
     x, y = location
-    viewshed_filename = f"{folder}/viewshed.tif"
-    call(
-        [
-            "gdal_viewshed", '-b', '1', '-md', '20000',
-            '-ox', str(x), '-oy', str(y), dem_file, viewshed_filename
-        ])
-    return os.path.exists(viewshed_filename)
+    horizon = compute_horizon(
+        ds_raster.band, ds_raster.transform, ds_raster.nodata, x, y,
+        observer_height, max_distance)
+    if horizon is not None and filename:
+        save_horizon(filename, horizon)
+    return horizon
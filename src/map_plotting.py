@@ -2,6 +2,7 @@ import base64
 from dotenv import load_dotenv
 import folium
 import folium.raster_layers
+import numpy as np
 import os
 import location_handler
 from tools.debug import p_i
@@ -216,10 +217,10 @@ def plot_to_map(
     if locs:
         locs_fg = folium.FeatureGroup(name="Retrieved Coordinates", show=True)
         m.add_child(locs_fg)
-        for i in locs:
-            loc = converter.convert(*i)
+        lats, lons = converter.convert_many(*np.asarray(locs, dtype=np.float64).T)
+        for lat, lon in zip(lats, lons):
             folium.Circle(
-                location=(loc.latitude, loc.longitude),
+                location=(lat, lon),
                 color="#0a6496",
                 fill=True,
                 fill_color="#0a6496",
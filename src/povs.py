@@ -1,3 +1,6 @@
+from math import cos, radians, sin
+
+
 def primary_pov(
     dem_file,
     raster_data,
@@ -5,22 +8,27 @@ def primary_pov(
     texture_path="",
     tex_bounds=None,
     mode="height",
+    angle=(360, 180),
+    yaw=0.0,
+    lod=None,
 ):
+    # lod is a list of nested height fields from tools.heightfield_lod used
+    # instead of the full resolution png
     coordinates = raster_data[0]
     location_x, location_height, location_y, view_x, _, view_y = coordinates
+    if yaw:
+        view_x, view_y = rotate_view(
+            location_x, location_y, view_x, view_y, yaw)
     _, max_height = raster_data[1]
     y_axis_scaling = vertical_exaggeration
 
-    if mode == "texture" or mode == "route" or mode == "gradient":
-        if mode == "gradient":
-            skew_x, skew_y, x_l, y_l = 0, 0, 0, 0
-        else:
-            if not tex_bounds:
-                raise Exception("No texture bounds given")
-            skew_y = tex_bounds.min_x[1]
-            skew_x = tex_bounds.min_y[0]
-            x_l = tex_bounds.max_x[1] - tex_bounds.min_x[1]
-            y_l = tex_bounds.max_y[0] - tex_bounds.min_y[0]
+    if mode == "texture" or mode == "route":
+        if not tex_bounds:
+            raise Exception("No texture bounds given")
+        skew_y = tex_bounds.min_x[1]
+        skew_x = tex_bounds.min_y[0]
+        x_l = tex_bounds.max_x[1] - tex_bounds.min_x[1]
+        y_l = tex_bounds.max_y[0] - tex_bounds.min_y[0]
     else:
         texture_path = ""
         skew_x, skew_y, x_l, y_l = 0, 0, 0, 0
@@ -41,6 +49,8 @@ def primary_pov(
     #declare CAMERAY = %f;
     #declare VIEWX = %f;
     #declare VIEWY = %f;
+    #declare HANGLE = %f;
+    #declare VANGLE = %f;
 
     #declare FILENAME = "%s";
     #declare YSCALE = %f;
@@ -49,6 +59,7 @@ def primary_pov(
     #declare SKEW = <%f, %f, 0.0>;
     #declare SCALE = <%f, %f, 0.0>;
     #declare MODE = "%s";
+    #declare TERRAIN = %s;
 
     #declare HEIGHT = CAMERAHEIGHT;
 
@@ -89,7 +100,7 @@ def primary_pov(
         }
     #end
 
-    #if (MODE="gradient")
+    #if (MODE="coordinates")
     global_settings {
         assumed_gamma 1
         max_trace_level 1
@@ -104,7 +115,7 @@ def primary_pov(
 
     camera {
         spherical
-        angle 360 180
+        angle HANGLE VANGLE
         location CAMERAPOS
         look_at CAMERALOOKAT
     }
@@ -112,7 +123,7 @@ def primary_pov(
     background { rgb <0, 0, 0> }
 
 
-    #if (MODE="gradient")
+    #if (MODE="coordinates")
     light_source { <0.5, 1, 0.5> color White }
     #else
     light_source { CAMERAPOS color White }
@@ -135,9 +146,8 @@ def primary_pov(
     #end
     merge {
         object{
-            height_field {
-                png FILENAME
-                water_level 0
+            object {
+                TERRAIN
                 #if (MODE="texture" | MODE="height")
                 pigment {
                     gradient y
@@ -179,16 +189,24 @@ def primary_pov(
                     translate CAMERAPOS
                 }
             #end
-            #if (MODE="gradient")
-                texture{
+            #if (MODE="coordinates")
+                // dem x, z and height in the red, green and blue channels,
+                // each pigment is weighted by a third in the average
+                texture {
                     pigment {
-                        image_map {
-                            png TEXTURE
-                            once
+                        average
+                        pigment_map {
+                            [1 function { clip(x, 0, 1) }
+                                color_map { [0 rgb 0] [1 rgb <3, 0, 0>] }]
+                            [1 function { clip(z, 0, 1) }
+                                color_map { [0 rgb 0] [1 rgb <0, 3, 0>] }]
+                            [1 function { clip(y, 0, 1) }
+                                color_map { [0 rgb 0] [1 rgb <0, 0, 3>] }]
                         }
                     }
-                    finish { ambient 1 diffuse 0 specular 0 }
-                    rotate <90, 0, 0>
+                    finish {
+                        ambient 0 diffuse 0 specular 0 emission 1
+                    }
                 }
             #end
         }
@@ -212,6 +230,7 @@ def primary_pov(
         location_y,
         view_x,
         view_y,
+        *angle,
         dem_file.replace('.tif', '.png'),
         y_axis_scaling,
         max_height,
@@ -221,10 +240,59 @@ def primary_pov(
         y_l,
         x_l,
         mode,
+        lod_terrain(lod) if lod else "height_field { png FILENAME water_level 0 }",
     )
     return pov_text
 
 
+def lod_terrain(levels):
+    # each level is cut to its window, the walls of the cut close the seams
+    # between levels, and coarser levels leave out the finer ones inside
+    objects = []
+    for level in levels:
+        min_x, min_z, max_x, max_z = level["bounds"]
+        # keeps the walls of the cut off the edges of the height field
+        inset = 1e-6
+        terrain = """intersection {
+            height_field {
+                png "%s"
+                water_level 0
+                scale <%.9f, 1, %.9f>
+                translate <%.9f, 0, %.9f>
+            }
+            box { <%.9f, -1, %.9f>, <%.9f, 2, %.9f> }
+        }""" % (
+            level["file"],
+            max_x - min_x,
+            max_z - min_z,
+            min_x,
+            min_z,
+            min_x + inset,
+            min_z + inset,
+            max_x - inset,
+            max_z - inset,
+        )
+        if level["hole"]:
+            terrain = """difference {
+            %s
+            box { <%.9f, -1, %.9f>, <%.9f, 2, %.9f> }
+        }""" % (terrain, *level["hole"])
+        objects.append(terrain)
+    return "union {\n        %s\n    }" % "\n        ".join(objects)
+
+
+def rotate_view(location_x, location_y, view_x, view_y, yaw):
+    # turn the look at point yaw degrees to the right around the camera,
+    # right being the direction povray lays out the spherical image in
+    forward_x, forward_y = view_x - location_x, view_y - location_y
+    right_x, right_y = forward_y, -forward_x
+    theta = radians(yaw)
+    return (
+        location_x + cos(theta) * forward_x + sin(theta) * right_x,
+        location_y + cos(theta) * forward_y + sin(theta) * right_y,
+    )
+
+
 def debug_pov(dem_file, texture_path, tex_bounds, mh):
     with_route_texture = bool(texture_path and tex_bounds)
     if with_route_texture:
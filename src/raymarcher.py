@@ -0,0 +1,302 @@
+import numpy as np
+import rasterio
+from tools.converters import HEIGHT_FIELD_OFFSET, HEIGHT_FIELD_RANGE
+
+# scene constants mirrored from povs.primary_pov
+WATER_LEVEL = 0.0002525
+WATER_COLOR = (0.16, 0.41, 0.52)
+AMBIENT_LIGHT = 1.5
+TERRAIN_AMBIENT = 0.2
+TERRAIN_DIFFUSE = 0.55
+TERRAIN_COLORS = [
+    (0.0001, (0.01, 0.40, 0.26)),
+    (0.0035, (0.89, 0.79, 0.45)),
+    (0.0070, (0.78, 0.58, 0.27)),
+    (0.0105, (0.62, 0.16, 0.00)),
+    (0.0140, (0.60, 0.60, 0.60)),
+    (0.0200, (0.78, 0.58, 0.27)),
+    (0.0235, (0.62, 0.16, 0.00)),
+    (0.0270, (0.60, 0.60, 0.60)),
+]
+SKY_COLORS = [
+    (0.25, (0.95, 0.98, 0.99)),
+    (0.7, (0.54, 0.76, 0.85)),
+    (1.0, (0.23, 0.60, 0.74)),
+]
+
+
+def load_heightfield(dem_file):
+    # same values povray reads from the UInt16 png written next to the tif
+    with rasterio.open(dem_file) as ds_raster:
+        band = ds_raster.read(1)
+    return np.clip(band, 0, HEIGHT_FIELD_RANGE).astype(np.float32) / HEIGHT_FIELD_RANGE
+
+
+def apply_color_map(values, color_map):
+    positions = np.array([p for p, _ in color_map], dtype=np.float32)
+    colors = np.array([c for _, c in color_map], dtype=np.float32)
+    order = np.argsort(positions, kind="stable")
+    positions, colors = positions[order], colors[order]
+    return np.stack(
+        [np.interp(values, positions, colors[:, i]) for i in range(3)], axis=-1
+    )
+
+
+def sample_heightfield(heightfield, x, z):
+    # bilinear sample, x runs along the columns and z from the bottom row up
+    rows, cols = heightfield.shape
+    fx = np.clip(x, 0, 1) * (cols - 1)
+    fz = (1 - np.clip(z, 0, 1)) * (rows - 1)
+    c0 = np.minimum(fx.astype(np.int32), cols - 2)
+    r0 = np.minimum(fz.astype(np.int32), rows - 2)
+    tx = fx - c0
+    tz = fz - r0
+    top = heightfield[r0, c0] * (1 - tx) + heightfield[r0, c0 + 1] * tx
+    bottom = heightfield[r0 + 1, c0] * (1 - tx) + heightfield[r0 + 1, c0 + 1] * tx
+    return top * (1 - tz) + bottom * tz
+
+
+def get_march_distances(heightfield, angular_step):
+    # horizontal distances to sample, one dem cell apart close to the camera
+    # and growing with the angular size of an output pixel further out
+    min_step = 0.5 / max(heightfield.shape)
+    distances = [0.0]
+    while distances[-1] < np.sqrt(2):
+        distances.append(distances[-1] + max(min_step, distances[-1] * angular_step))
+    return np.array(distances, dtype=np.float32)
+
+
+def march_rays(heightfield, camera, directions, tan_pitch, distances, va, water, chunk=64):
+    cx, cy, cz = camera
+    n_rays = len(tan_pitch)
+    hit_distance = np.full(n_rays, np.nan, dtype=np.float32)
+    y_max = (heightfield.max() + HEIGHT_FIELD_OFFSET) * va
+    active = np.flatnonzero(~((tan_pitch >= 0) & (cy > y_max)))
+    prev_gap = None
+
+    for start in range(0, len(distances), chunk):
+        if len(active) == 0:
+            break
+        s = distances[start:start + chunk]
+        x = cx + directions[active, 0, None] * s
+        z = cz + directions[active, 1, None] * s
+        y = cy + tan_pitch[active, None] * s
+        inside = (x >= 0) & (x <= 1) & (z >= 0) & (z <= 1)
+        ground = np.where(
+            inside,
+            (sample_heightfield(heightfield, x, z) + HEIGHT_FIELD_OFFSET) * va,
+            -np.inf,
+        )
+        if water:
+            ground = np.maximum(ground, WATER_LEVEL * va)
+        gap = y - ground
+
+        below = gap <= 0
+        hit = below.any(axis=1)
+        first = below.argmax(axis=1)
+        rays = np.flatnonzero(hit)
+        k = first[rays]
+        gap_k = gap[rays, k]
+        if prev_gap is None:
+            gap_prev = np.where(k > 0, gap[rays, np.maximum(k - 1, 0)], gap_k)
+        else:
+            gap_prev = np.where(
+                k > 0, gap[rays, np.maximum(k - 1, 0)], prev_gap[rays])
+        s_k = s[k]
+        s_prev = np.where(
+            k > 0, s[np.maximum(k - 1, 0)], distances[max(start - 1, 0)])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(gap_prev > gap_k, gap_prev / (gap_prev - gap_k), 0)
+        hit_distance[active[rays]] = s_prev + (s_k - s_prev) * np.clip(t, 0, 1)
+
+        # rays that left the dem or climbed above its highest point never
+        # come back, the water plane is handled analytically below
+        escaped = ~inside[:, -1] | ((tan_pitch[active] >= 0) & (y[:, -1] > y_max))
+        keep = ~hit & ~escaped
+        prev_gap = gap[keep, -1]
+        active = active[keep]
+
+    if water:
+        misses = np.isnan(hit_distance) & (tan_pitch < 0)
+        hit_distance[misses] = (cy - WATER_LEVEL * va) / -tan_pitch[misses]
+    return hit_distance
+
+
+def get_terrain_normals(heightfield, va):
+    rows, cols = heightfield.shape
+    d_row, d_col = np.gradient(heightfield * va)
+    d_x = d_col * (cols - 1)
+    d_z = -d_row * (rows - 1)
+    normals = np.stack([-d_x, np.ones_like(d_x), -d_z], axis=-1)
+    return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+
+def shade_height(heightfield, normals, camera, points, pitch, hits, max_mountain):
+    rows, cols = heightfield.shape
+    x, y, z = points
+    colors = apply_color_map((np.sin(pitch) + 1) / 2, SKY_COLORS)
+
+    on_dem = hits & (x >= 0) & (x <= 1) & (z >= 0) & (z <= 1)
+    v = sample_heightfield(heightfield, x[on_dem], z[on_dem])
+    terrain = np.zeros_like(hits)
+    terrain[on_dem] = v >= WATER_LEVEL - HEIGHT_FIELD_OFFSET
+    water = hits & ~terrain
+
+    v = sample_heightfield(heightfield, x[terrain], z[terrain])
+    col = np.clip(np.rint(x[terrain] * (cols - 1)), 0, cols - 1).astype(np.int32)
+    row = np.clip(np.rint((1 - z[terrain]) * (rows - 1)), 0, rows - 1).astype(np.int32)
+    to_light = np.stack(
+        [camera[0] - x[terrain], camera[1] - y[terrain], camera[2] - z[terrain]],
+        axis=-1,
+    )
+    to_light /= np.maximum(np.linalg.norm(to_light, axis=-1, keepdims=True), 1e-9)
+    diffuse = np.maximum((normals[row, col] * to_light).sum(axis=-1), 0)
+    base = apply_color_map(v, TERRAIN_COLORS + [(max_mountain, (1.0, 1.0, 1.0))])
+    colors[terrain] = base * (
+        TERRAIN_AMBIENT * AMBIENT_LIGHT + TERRAIN_DIFFUSE * diffuse)[:, None]
+    colors[water] = np.array(WATER_COLOR) * AMBIENT_LIGHT
+    return np.clip(colors, 0, 1)
+
+
+def shade_depth(camera, forward, points, hits):
+    # clipped_scaled_gradient in primary_pov with DEPTHMIN -1 and DEPTHMAX 0
+    x, _, z = points
+    depth = np.zeros(hits.shape, dtype=np.float32)
+    depth[hits] = np.clip(
+        1 - ((x[hits] - camera[0]) * forward[0] + (z[hits] - camera[2]) * forward[1]),
+        0,
+        1,
+    )
+    return depth
+
+
+def shade_coordinates(points, hits, va):
+    # dem x, z and unscaled height like the coordinates mode in primary_pov,
+    # the height field offset keeps the height above zero on terrain
+    x, y, z = points
+    coordinates = np.stack([x, z, y / va], axis=-1)
+    coordinates[~hits] = 0
+    return coordinates
+
+
+def get_water_distance(camera, tan_pitch, va):
+    # horizontal distance to the water plane, nan for rays that never reach it
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(
+            tan_pitch < 0, (camera[1] - WATER_LEVEL * va) / -tan_pitch, np.nan
+        ).astype(np.float32)
+
+
+def render_spherical(
+    dem_file,
+    raster_data,
+    vertical_exaggeration,
+    dimensions,
+    mode="height",
+    block_rows=16,
+    angle=(360, 180),
+    yaw=0.0,
+    row_range=None,
+):
+    return render_spherical_modes(
+        dem_file, raster_data, vertical_exaggeration, dimensions, [mode],
+        block_rows, angle, yaw, row_range,
+    )[mode]
+
+
+def render_spherical_modes(
+    dem_file,
+    raster_data,
+    vertical_exaggeration,
+    dimensions,
+    modes,
+    block_rows=16,
+    angle=(360, 180),
+    yaw=0.0,
+    row_range=None,
+):
+    # angle and yaw follow the povray camera in primary_pov, row_range
+    # limits the output to those rows of the frame like +SR/+ER. every mode
+    # is shaded from the same marched rays, the water plane only shows up in
+    # the height mode and is added analytically
+    for mode in modes:
+        if mode not in ("height", "depth", "coordinates"):
+            raise Exception(
+                f"Mode {mode} is not supported by the numpy renderer")
+    width, height = dimensions
+    first_row, last_row = row_range if row_range else (0, height)
+    location_x, location_height, location_y, view_x, _, view_y = raster_data[0]
+    _, max_mountain = raster_data[1]
+    camera = np.array([location_x, location_height, location_y], dtype=np.float32)
+    forward = np.array([view_x - location_x, view_y - location_y], dtype=np.float32)
+    forward /= np.linalg.norm(forward)
+    right = np.array([forward[1], -forward[0]], dtype=np.float32)
+    h_angle, v_angle = np.radians(angle)
+    va = vertical_exaggeration
+
+    heightfield = load_heightfield(dem_file)
+    normals = get_terrain_normals(heightfield, va) if "height" in modes else None
+    distances = get_march_distances(heightfield, v_angle / height)
+
+    column_yaw = ((np.arange(width, dtype=np.float32) + 0.5) / width - 0.5) * h_angle
+    column_yaw += np.radians(yaw)
+    directions = np.cos(column_yaw)[:, None] * forward + \
+        np.sin(column_yaw)[:, None] * right
+
+    channels = {"height": 3, "depth": 1, "coordinates": 3}
+    out = {
+        mode: np.zeros(
+            (last_row - first_row, width, channels[mode]), dtype=np.float32)
+        for mode in modes
+    }
+
+    for row_start in range(first_row, last_row, block_rows):
+        rows = np.arange(row_start, min(row_start + block_rows, last_row))
+        pitch = v_angle / 2 - (rows + 0.5) * v_angle / height
+        block_pitch = np.repeat(pitch, width).astype(np.float32)
+        block_directions = np.tile(directions, (len(rows), 1))
+        tan_pitch = np.tan(block_pitch)
+        terrain_distance = march_rays(
+            heightfield, camera, block_directions, tan_pitch,
+            distances, va, water=False,
+        )
+        for mode in modes:
+            if mode == "height":
+                hit_distance = np.fmin(
+                    terrain_distance, get_water_distance(camera, tan_pitch, va))
+            else:
+                hit_distance = terrain_distance
+            hits = ~np.isnan(hit_distance)
+            s = np.nan_to_num(hit_distance)
+            points = (
+                camera[0] + block_directions[:, 0] * s,
+                camera[1] + tan_pitch * s,
+                camera[2] + block_directions[:, 1] * s,
+            )
+            if mode == "height":
+                shaded = shade_height(
+                    heightfield, normals, camera, points, block_pitch, hits,
+                    max_mountain)
+            elif mode == "coordinates":
+                shaded = shade_coordinates(points, hits, va)
+            else:
+                shaded = shade_depth(camera, forward, points, hits)
+            out[mode][rows - first_row] = shaded.reshape(len(rows), width, -1)
+    return {
+        mode: render[:, :, 0] if mode == "depth" else render
+        for mode, render in out.items()
+    }
+
+
+def to_png_array(render, mode="height"):
+    # 16 bit image in the layout povray writes, srgb encoded in color modes
+    if mode == "height":
+        render = np.where(
+            render <= 0.0031308,
+            render * 12.92,
+            1.055 * np.power(render, 1 / 2.4) - 0.055,
+        )
+        render = render[:, :, ::-1]
+    elif mode == "coordinates":
+        render = render[:, :, ::-1]
+    return np.rint(np.clip(render, 0, 1) * 65535).astype(np.uint16)
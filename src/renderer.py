@@ -1,109 +1,529 @@
 import pickle
-from json import load
+from json import dump, load
+from math import ceil
 import os
 import time
 import subprocess
+import cv2
 from dotenv import load_dotenv
+from joblib import Parallel, delayed
+import numpy as np
 import rasterio
 import requests
 from image_handling import verify_viewpoint
-from tools.converters import convert_coordinates
-from tools.debug import p_e, p_i, p_line
+from tools.debug import p_a, p_e, p_i, p_line
 from location_handler import (
+    create_horizon,
     create_viewshed,
     get_3d_location,
     find_visible_items_in_ds,
+    find_visible_items_in_horizon,
+    get_heights_from_raster,
     get_raster_data,
+    get_raster_path,
 )
+from jobs import enqueue, get_job
 from map_plotting import plot_to_map
 from povs import primary_pov
+from raymarcher import render_spherical, render_spherical_modes, to_png_array
 from tools.file_handling import (
     get_mountain_data,
+    load_image_data,
     read_image_locations,
-    read_mountain_gpx,
+    read_mountains_near,
     save_image_data,
 )
-from tools.types import CrsToLatLng, LatLngToCrs, Location
+from tools.coordinate_buffer import get_camera_position, save_coordinate_buffer
+from tools.heightfield_lod import build_lod_heightfield, get_pixel_angle
+from tools.horizon import load_horizon
+from tools.raster import export_raster, open_raster
+from tools.peak_index import open_peak_index
+from tools.render_cache import fetch_render, get_render_key, store_render
+from tools.types import Location, get_crs_to_latlng, get_latlng_to_crs
+from tools.viewshed import VIEWSHED_MAX_DISTANCE, get_viewshed_path, open_viewshed
+from tools.workspace import scratch_workspace
 from vistools.tplot import plot_3d
 from requests.structures import CaseInsensitiveDict
 
 
 def render_height(img_data, r_h=None, debug=False):
     if os.path.exists(img_data.render_path) and not debug:
+        resume_final_render(img_data)
         return
     start_time = time.time()
     render_filename = img_data.render_path
-    pov_filename = "/tmp/pov_file.pov"
     render_settings_path = "render_settings.json"
     vertical_exaggeration = 3.0
 
+    dem_file = get_raster_path()
     with open(render_settings_path) as json_file:
         data = load(json_file)
-        dem_file = data["dem_path"]
-        if r_h:
-            render_shape = [r_h * 2, r_h]
-        else:
-            r_height = data["render_height"]
-            r_width = r_height * 2
-            render_shape = [r_width, r_height]
+        render_shape = get_render_shape(data, r_h)
+        render_backend = data.get("render_backend", "povray")
+        cache_folder = data.get("render_cache_path", "data/cache/renders")
+        preview_scale = data.get("preview_scale", 0)
         json_file.close()
 
     cropped_dem, coordinates, image_location = get_mountain_data(
         dem_file, img_data)
-    ds_raster = rasterio.open(cropped_dem)
-    raster_data, elevation = get_raster_data(
+    ds_raster = open_raster(cropped_dem)
+    raster_data, elevation, camera_height = get_raster_data(
         ds_raster, coordinates, vertical_exaggeration)
     if not raster_data:
         return
     pickle.dump([cropped_dem, coordinates, image_location, elevation], open(
         f"{img_data.folder}/vs.pkl", "wb"))
     pov_mode = "height"
+    render_key, coordinates_key = get_render_keys(
+        dem_file, ds_raster, coordinates, vertical_exaggeration, render_shape,
+        data)
+    previews = position_camera(
+        cropped_dem, raster_data, vertical_exaggeration, camera_height,
+        render_backend)
 
-    # position viewpoint as close as possible to the terrain
-    raster_data[0][1] = raster_data[0][1] - 0.0001
-    while True:
-        pov = primary_pov(cropped_dem, raster_data,
-                          vertical_exaggeration, mode=pov_mode)
-        params = [pov_filename, render_filename, [200, 100], "color"]
-        with open(pov_filename, "w") as pf:
-            pf.write(pov)
-        pf.close()
-        print(f"Rendering {render_filename}")
-        execute_pov(params)
-        if verify_viewpoint(render_filename):
+    if not debug and fetch_render(cache_folder, render_key, render_filename):
+        render_coordinates(
+            img_data, cropped_dem, raster_data, vertical_exaggeration,
+            render_shape, coordinates_key, data)
+        return True
+
+    if not preview_scale or debug:
+        return render_final(
+            img_data, cropped_dem, raster_data, vertical_exaggeration,
+            render_shape, render_key, coordinates_key, data, start_time,
+            previews)
+
+    # lets other processes, like the flask server, wait for the final
+    # render. made before the preview so a preview never exists without it
+    write_pending(img_data, render_shape)
+    # quick low quality render the user can pick points in while the
+    # final render job replaces it
+    preview_shape = [max(int(d * preview_scale), 1) for d in render_shape]
+    if render_backend == "numpy":
+        execute_raymarch(cropped_dem, raster_data, vertical_exaggeration,
+                         render_filename, preview_shape, pov_mode)
+    else:
+        with scratch_workspace() as workspace:
+            lod = get_lod(cropped_dem, raster_data, preview_shape, data,
+                          workspace)
             pov = primary_pov(cropped_dem, raster_data,
-                              vertical_exaggeration, mode=pov_mode)
-            params = [pov_filename, render_filename, render_shape, "color"]
+                              vertical_exaggeration, mode=pov_mode, lod=lod)
+            pov_filename = f"{workspace}/pov_file.pov"
             with open(pov_filename, "w") as pf:
                 pf.write(pov)
             pf.close()
-            print(f"Rendering {render_filename}")
+            execute_pov(
+                [pov_filename, render_filename, preview_shape, "preview"])
+    p_i(f"Preview of {img_data.filename} ready after "
+        f"{time.time() - start_time:.2f} seconds")
+    queue_final_render(img_data, render_shape)
+    return True
+
+
+def get_render_shape(settings, r_h=None):
+    r_height = r_h or settings["render_height"]
+    return [r_height * 2, r_height]
+
+
+def get_render_keys(dem_file, ds_raster, coordinates, vertical_exaggeration, render_shape, settings):
+    # cache keys of the height render and of its coordinate buffer
+    render_backend = settings.get("render_backend", "povray")
+    # only povray renders the level of detail height field
+    use_lod = render_backend == "povray" and settings.get("lod_heightfield", False)
+    return tuple(
+        get_render_key(
+            dem_file, ds_raster.bounds, coordinates, vertical_exaggeration,
+            mode, render_shape, render_backend, use_lod)
+        for mode in ("height", "coordinates")
+    )
+
+
+def write_pending(img_data, render_shape, job_id=None):
+    with open(f"{img_data.render_path}.pending", "w") as pending:
+        dump({"job_id": job_id, "render_shape": render_shape}, pending)
+
+
+def read_pending(img_data):
+    # the final render job noted next to the preview, None when there is no
+    # final render to wait for
+    try:
+        with open(f"{img_data.render_path}.pending") as pending:
+            return load(pending)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # cut short by a worker that died while writing it
+        return {}
+
+
+def remove_pending(img_data):
+    try:
+        os.remove(f"{img_data.render_path}.pending")
+    except FileNotFoundError:
+        pass
+
+
+def final_render_queued(img_data):
+    pending = read_pending(img_data)
+    if not pending or not pending.get("job_id"):
+        return False
+    job = get_job(pending["job_id"])
+    return job is not None and job["status"] in ("queued", "running")
+
+
+def queue_final_render(img_data, render_shape):
+    # the final render is a job of its own, so it survives the worker that
+    # rendered the preview and is run again if its own worker dies
+    job_id = enqueue(
+        "renderfinal", filename=img_data.filename, render_shape=render_shape)
+    write_pending(img_data, render_shape, job_id)
+    return job_id
+
+
+def resume_final_render(img_data):
+    # a preview whose final render job failed, or was never queued because
+    # the worker died after the preview, is queued again
+    pending = read_pending(img_data)
+    if pending is None or final_render_queued(img_data):
+        return
+    p_a(f"Final render of {img_data.filename} was interrupted, queueing it again")
+    queue_final_render(img_data, pending.get("render_shape"))
+
+
+def render_queued_final(img_data, render_shape=None):
+    # the final render job queued by render_height, from the viewpoint the
+    # preview was rendered from
+    start_time = time.time()
+    vertical_exaggeration = 3.0
+    with open("render_settings.json") as json_file:
+        data = load(json_file)
+    render_shape = render_shape or get_render_shape(data)
+    cropped_dem, coordinates, _, _ = load_viewpoint(img_data)
+    ds_raster = open_raster(cropped_dem)
+    raster_data, _, camera_height = get_raster_data(
+        ds_raster, coordinates, vertical_exaggeration)
+    if not raster_data:
+        remove_pending(img_data)
+        return False
+    render_key, coordinates_key = get_render_keys(
+        get_raster_path(), ds_raster, coordinates, vertical_exaggeration,
+        render_shape, data)
+    previews = position_camera(
+        cropped_dem, raster_data, vertical_exaggeration, camera_height,
+        data.get("render_backend", "povray"))
+    return render_final(
+        img_data, cropped_dem, raster_data, vertical_exaggeration,
+        render_shape, render_key, coordinates_key, data, start_time,
+        previews)
+
+
+def render_final(
+    img_data,
+    cropped_dem,
+    raster_data,
+    vertical_exaggeration,
+    render_shape,
+    render_key,
+    coordinates_key,
+    settings,
+    start_time,
+    previews,
+):
+    render_filename = img_data.render_path
+    # render next to the preview and swap it in when done
+    final_filename = render_filename.replace(".png", "-final.png")
+    pov_mode = "height"
+    render_backend = settings.get("render_backend", "povray")
+    cache_folder = settings.get("render_cache_path", "data/cache/renders")
+    cache_size_mb = settings.get("render_cache_size_mb", 2048)
+
+    print(f"Rendering {render_filename}")
+    with scratch_workspace() as workspace:
+        outputs = {pov_mode: final_filename}
+        if coordinates_needed(img_data, coordinates_key, settings):
+            outputs["coordinates"] = f"{workspace}/coordinates.png"
+        strip_durations = render_modes(
+            cropped_dem, raster_data, vertical_exaggeration, outputs,
+            render_shape, settings, workspace)
+        render_complete = os.path.exists(final_filename)
+        if render_complete and "coordinates" in outputs:
+            save_coordinates(
+                img_data, cropped_dem, raster_data, vertical_exaggeration,
+                outputs["coordinates"], coordinates_key, settings)
+    if render_complete:
+        os.replace(final_filename, render_filename)
+    remove_pending(img_data)
+    if not render_complete:
+        p_e(f"Final render of {img_data.filename} failed")
+        return False
+    store_render(cache_folder, render_key, render_filename, cache_size_mb)
+
+    previews_rendered, previews_skipped = previews
+    stats = [
+        "Information about completed task: \n",
+        f"File:      {img_data.filename}",
+        f"Mode:      {', '.join(outputs)}",
+        f"Backend:   {render_backend}",
+        f"Duration:  {time.time() - start_time} seconds",
+        f"Previews:  {previews_rendered} rendered, "
+        f"about {previews_skipped} skipped (estimated)",
+    ]
+    if strip_durations:
+        stats.append(
+            f"Strips:    {len(strip_durations)}, slowest "
+            f"{max(strip_durations):.2f} seconds")
+    p_line(stats)
+    return True
+
+
+def render_modes(
+    dem_file,
+    raster_data,
+    vertical_exaggeration,
+    outputs,
+    dimensions,
+    settings,
+    workspace,
+):
+    # renders every primary_pov mode in outputs, a dict of mode and file
+    # name, with the configured backend. returns the strip durations
+    render_workers = settings.get("render_workers", 1)
+    strip_orientation = settings.get("render_strip_orientation", "rows")
+    render_backend = settings.get("render_backend", "povray")
+    if render_backend == "numpy":
+        execute_raymarch_modes(
+            dem_file, raster_data, vertical_exaggeration, outputs, dimensions)
+        return []
+    lod = get_lod(dem_file, raster_data, dimensions, settings, workspace)
+    # povray gets one run per mode. a run writes a single image, and
+    # animation frames re-parse the scene and reload the height field, so
+    # batching modes as frames saves nothing. the modes can't share one
+    # trace either: color renders need +A and file gamma, which would blend
+    # coordinate and depth values at the silhouettes the hotspots sit on.
+    # the numpy backend above shades every mode from one pass
+    strip_durations = []
+    for mode, out_filename in outputs.items():
+        pov_filename = f"{workspace}/pov_file-{mode}.pov"
+        with open(pov_filename, "w") as pf:
+            pf.write(primary_pov(
+                dem_file, raster_data, vertical_exaggeration, mode=mode,
+                lod=lod))
+        pf.close()
+        params = [pov_filename, out_filename, dimensions,
+                  POV_OUTPUT_MODES.get(mode, mode)]
+        if render_workers == 1:
             execute_pov(params)
-            break
-        raster_data[0][1] = raster_data[0][1] + 0.00005
+        else:
+            strip_durations += execute_pov_strips(
+                params, render_workers, strip_orientation)
+    return strip_durations
+
+
+def get_lod(dem_file, raster_data, dimensions, settings, workspace, angle=(360, 180)):
+    # nested height fields for povray, written to workspace, or None to
+    # render the full resolution crop
+    if not settings.get("lod_heightfield", False):
+        return None
+    return build_lod_heightfield(
+        dem_file, raster_data, get_pixel_angle(dimensions, angle), workspace)
+
+
+def coordinates_needed(img_data, coordinates_key, settings):
+    # per pixel dem position and distance for the render, off by default as
+    # it costs a second full resolution render. a cached buffer is fetched
+    # right away
+    if not img_data.coordinates_path or not settings.get("coordinate_buffer", False):
+        return False
+    cache_folder = settings.get("render_cache_path", "data/cache/renders")
+    return not fetch_render(
+        cache_folder, coordinates_key, img_data.coordinates_path)
+
+
+def render_coordinates(
+    img_data,
+    cropped_dem,
+    raster_data,
+    vertical_exaggeration,
+    render_shape,
+    coordinates_key,
+    settings,
+):
+    if not coordinates_needed(img_data, coordinates_key, settings):
+        return
+    with scratch_workspace() as workspace:
+        coordinates_filename = f"{workspace}/coordinates.png"
+        render_modes(
+            cropped_dem, raster_data, vertical_exaggeration,
+            {"coordinates": coordinates_filename}, render_shape, settings,
+            workspace)
+        save_coordinates(
+            img_data, cropped_dem, raster_data, vertical_exaggeration,
+            coordinates_filename, coordinates_key, settings)
+
+
+def save_coordinates(
+    img_data,
+    cropped_dem,
+    raster_data,
+    vertical_exaggeration,
+    coordinates_filename,
+    coordinates_key,
+    settings,
+):
+    cache_folder = settings.get("render_cache_path", "data/cache/renders")
+    cache_size_mb = settings.get("render_cache_size_mb", 2048)
+    ds_raster = rasterio.open(cropped_dem)
+    b = ds_raster.bounds
+    bounds = [b.left, b.bottom, b.right, b.top]
+    crs = int(ds_raster.crs.to_authority()[1])
+    camera = get_camera_position(bounds, raster_data, vertical_exaggeration)
+    if not save_coordinate_buffer(
+        coordinates_filename, img_data.coordinates_path, bounds, crs, camera
+    ):
+        p_e(f"Coordinate buffer of {img_data.filename} failed")
+        return False
+    store_render(
+        cache_folder, coordinates_key, img_data.coordinates_path, cache_size_mb)
+    return True
+
+
+def position_camera(
+    dem_file,
+    raster_data,
+    vertical_exaggeration,
+    camera_height,
+    render_backend="povray",
+):
+    # position viewpoint as close as possible to the terrain
+    preview_step = 0.00005
+    previews_rendered = 0
+    previews_skipped = 0
+    initial_height = raster_data[0][1] - 0.0001
+    if camera_height is not None:
+        # not counted, an estimate of the previews the stepping below would
+        # have rendered to climb from initial_height to camera_height
+        previews_skipped = max(
+            ceil((camera_height - initial_height) / preview_step), 0) + 1
+        raster_data[0][1] = camera_height
+        return previews_rendered, previews_skipped
+
+    p_a("Could not sample terrain around camera, verifying with previews")
+    raster_data[0][1] = initial_height
+    with scratch_workspace() as workspace:
+        pov_filename = f"{workspace}/pov_file.pov"
+        preview_filename = f"{workspace}/preview.png"
+        while True:
+            if render_backend == "numpy":
+                execute_raymarch(dem_file, raster_data, vertical_exaggeration,
+                                 preview_filename, [200, 100], "height")
+            else:
+                pov = primary_pov(dem_file, raster_data,
+                                  vertical_exaggeration, mode="height")
+                params = [pov_filename, preview_filename, [200, 100], "color"]
+                with open(pov_filename, "w") as pf:
+                    pf.write(pov)
+                pf.close()
+                print(f"Rendering {preview_filename}")
+                execute_pov(params)
+            previews_rendered += 1
+            if verify_viewpoint(preview_filename):
+                break
+            raster_data[0][1] = raster_data[0][1] + preview_step
+    return previews_rendered, previews_skipped
+
 
+def render_crop(img_data):
+    # re-render only the yaw range and pitch band covered by the warped
+    # panorama, at crop_render_scale times the resolution of the render
+    render_settings_path = "render_settings.json"
+    vertical_exaggeration = 3.0
+    with open(render_settings_path) as json_file:
+        data = load(json_file)
+        scale = data.get("crop_render_scale", 0)
+        render_workers = data.get("render_workers", 1)
+        render_backend = data.get("render_backend", "povray")
+        json_file.close()
+    if not scale or img_data.render_bbox is None:
+        return False
+    if img_data.crop_render_path is None:
+        img_data.crop_render_path = img_data.render_path.replace(
+            "-render.png", "-render-crop.png")
+
+    start_time = time.time()
+    minx, miny, maxx, maxy, render_width, full_height = img_data.render_bbox
+    miny, maxy = max(miny, 0), min(maxy, full_height)
+    h_angle = (maxx - minx) * 360 / render_width
+    yaw = (minx + maxx) / 2 * 360 / render_width - 180
+    dimensions = [int((maxx - minx) * scale), int(full_height * scale)]
+    rows = (int(miny * scale), int(maxy * scale))
+
+    cropped_dem, coordinates, _, _ = load_viewpoint(img_data)
+    ds_raster = open_raster(cropped_dem)
+    raster_data, _, camera_height = get_raster_data(
+        ds_raster, coordinates, vertical_exaggeration)
+    if not raster_data:
+        return False
+    position_camera(
+        cropped_dem, raster_data, vertical_exaggeration, camera_height,
+        render_backend)
+
+    if render_backend == "numpy":
+        p_i("Generating %s" % img_data.crop_render_path)
+        render = render_spherical(
+            cropped_dem, raster_data, vertical_exaggeration, dimensions,
+            angle=(h_angle, 180), yaw=yaw, row_range=rows)
+        cv2.imwrite(img_data.crop_render_path, to_png_array(render))
+    else:
+        with scratch_workspace() as workspace:
+            lod = get_lod(cropped_dem, raster_data, dimensions, data,
+                          workspace, angle=(h_angle, 180))
+            pov = primary_pov(cropped_dem, raster_data, vertical_exaggeration,
+                              mode="height", angle=(h_angle, 180), yaw=yaw,
+                              lod=lod)
+            pov_filename = f"{workspace}/pov_file.pov"
+            params = [pov_filename, img_data.crop_render_path,
+                      dimensions, "color"]
+            with open(pov_filename, "w") as pf:
+                pf.write(pov)
+            pf.close()
+            if not execute_pov_strips(params, render_workers, "rows", span=rows):
+                return False
+
+    img_data.crop_scale = scale
     stats = [
         "Information about completed task: \n",
         f"File:      {img_data.filename}",
-        f"Mode:      {pov_mode}",
+        f"Crop:      {h_angle:.1f} degrees, rows {rows[0]}-{rows[1]}",
+        f"Size:      {dimensions[0]}x{rows[1] - rows[0]}",
         f"Duration:  {time.time() - start_time} seconds",
     ]
     p_line(stats)
     return True
 
 
-def generate_viewshed(img_data):
+def load_viewpoint(img_data):
     cropped_dem, coordinates, image_location, elevation = pickle.load(
         open(f"{img_data.folder}/vs.pkl", "rb"))
-    ds_raster = rasterio.open(cropped_dem)
+    if not os.path.exists(cropped_dem):
+        # evicted from the crop cache since the render, crop it again
+        cropped_dem, _, _ = get_mountain_data(get_raster_path(), img_data)
+    return cropped_dem, coordinates, image_location, elevation
+
+
+def generate_viewshed(img_data):
+    cropped_dem, coordinates, image_location, elevation = load_viewpoint(
+        img_data)
+    ds_raster = open_raster(cropped_dem)
     p_i(f"Creating viewshed for {img_data.filename}")
-    converter = LatLngToCrs(int(ds_raster.crs.to_authority()[1]))
+    converter = get_latlng_to_crs(ds_raster.crs)
     locxy = converter.convert(coordinates[0], coordinates[1])
-    vs_created = create_viewshed(cropped_dem, (locxy.GetX(),
-                                               locxy.GetY()), img_data.folder)
-    if not vs_created:
+    visible = create_viewshed(
+        cropped_dem, (locxy.GetX(), locxy.GetY()), img_data.folder)
+    if visible is None:
         p_e(f"Failed to create viewshed for {img_data.filename}")
         return False
+    create_horizon(
+        cropped_dem, (locxy.GetX(), locxy.GetY()), img_data.horizon_path)
     load_dotenv()
     api_key = os.getenv("MAPBOX_TOKEN")
     url = f"https://api.mapbox.com/geocoding/v5/mapbox.places/{image_location.longitude},{image_location.latitude}.json?access_token={api_key}"
@@ -117,35 +537,53 @@ def generate_viewshed(img_data):
     return True
 
 
+def share_lookup_rasters(img_data):
+    # exported once up front, so the lookup workers only memory map them
+    if not os.path.exists(f"{img_data.folder}/vs.pkl"):
+        return
+    cropped_dem, _, _, _ = load_viewpoint(img_data)
+    export_raster(cropped_dem)
+
+
+def share_peak_index(gpx_path):
+    # compiles the gpx once up front, the lookup workers memory map it
+    if not gpx_path or not os.path.exists(gpx_path):
+        return
+    with open("render_settings.json") as json_file:
+        peak_cache_folder = load(json_file).get(
+            "peak_cache_path", "data/cache/peaks")
+    with rasterio.open(get_raster_path()) as ds_raster:
+        crs = int(ds_raster.crs.to_authority()[1])
+    open_peak_index(gpx_path, crs, peak_cache_folder)
+
+
 def mountain_lookup(img_data, gpx_file, plot=False):
     p_i(f"Beginning mountain lookup for {img_data.filename}")
 
-    viewshed = f'{img_data.folder}/viewshed.tif'
-    ds_viewshed = rasterio.open(viewshed)
-    if not ds_viewshed:
+    viewshed = get_viewshed_path(img_data.folder)
+    if viewshed is None:
         return False
+    # images from before the horizon profiles fall back to the viewshed
+    horizon = None
+    if img_data.horizon_path and os.path.exists(img_data.horizon_path):
+        horizon = load_horizon(img_data.horizon_path)
 
-    render_settings_path = "render_settings.json"
-    with open(render_settings_path) as json_file:
+    dem_file = get_raster_path()
+    cropped_dem, coordinates, _, _ = load_viewpoint(img_data)
+    with open("render_settings.json") as json_file:
         data = load(json_file)
-        dem_file = data["dem_path"]
-        json_file.close()
+        peak_cache_folder = data.get("peak_cache_path", "data/cache/peaks")
+        curvature = data.get("hotspot_earth_curvature", False)
 
-    cropped_dem, coordinates, _, _ = pickle.load(
-        open(f"{img_data.folder}/vs.pkl", "rb"))
-
-    ds_raster = rasterio.open(cropped_dem)
-    crs = int(ds_raster.crs.to_authority()[1])
+    ds_raster = open_raster(cropped_dem)
+    crs = ds_raster.crs
     lat, lon = coordinates[0], coordinates[1]
 
-    converter = LatLngToCrs(crs)
-    camera_height = convert_coordinates(
-        ds_raster, converter, lat, lon, 1.0, True
-    )
+    converter = get_latlng_to_crs(crs)
+    camera_height = get_heights_from_raster(ds_raster, [lat], [lon])[0]
     camera_location = Location(lat, lon, camera_height)
 
-    viewshed = f'{img_data.folder}/viewshed.tif'
-    ds_viewshed = rasterio.open(viewshed)
+    ds_viewshed = open_viewshed(viewshed)
 
     """ visible_hikes = {}
     for hike in get_hikes():
@@ -161,28 +599,42 @@ def mountain_lookup(img_data, gpx_file, plot=False):
     fov = [img_data.fov_l, img_data.fov_r]
 
     images = read_image_locations(
-        img_data.filename, "src/static/images", ds_raster, converter
+        img_data.filename, "src/static/images", ds_raster
     )
-    images_in_sight = find_visible_items_in_ds(ds_viewshed, images)
+    if horizon is not None:
+        images_in_sight = find_visible_items_in_horizon(
+            horizon, ds_raster, images)
+    else:
+        images_in_sight = find_visible_items_in_ds(ds_viewshed, images)
     images_3d = get_3d_location(
         camera_location,
-        images_in_sight,
-        fov
+        [images[i] for i in images_in_sight],
+        fov,
+        curvature,
     )
 
-    mountains = read_mountain_gpx(gpx_file, converter)
-    mountains_in_sight = find_visible_items_in_ds(
-        ds_viewshed, mountains)
+    # the viewshed and horizon reach no further than this anyway
+    camera = converter.convert(lat, lon)
+    mountains = read_mountains_near(
+        gpx_file, crs, camera.GetX(), camera.GetY(), VIEWSHED_MAX_DISTANCE,
+        peak_cache_folder)
+    if horizon is not None:
+        mountains_in_sight = find_visible_items_in_horizon(
+            horizon, ds_raster, mountains)
+    else:
+        mountains_in_sight = find_visible_items_in_ds(
+            ds_viewshed, mountains)
     mountains_3d = get_3d_location(
         camera_location,
-        mountains_in_sight,
-        fov
+        [mountains[i] for i in mountains_in_sight],
+        fov,
+        curvature,
     )
 
     if plot:
         plotly_path = f"{img_data.folder}/{img_data.filename}-3d.json"
         if not os.path.exists(plotly_path):
-            plot_3d(ds_raster, plotly_path)
+            plot_3d(rasterio.open(cropped_dem), plotly_path)
 
         plot_filename = f"{img_data.folder}/{img_data.filename}-{gpx_file.split('/')[-1].split('.')[0]}.html"
         plot_to_map(
@@ -191,7 +643,7 @@ def mountain_lookup(img_data, gpx_file, plot=False):
             coordinates,
             plot_filename,
             dem_file,
-            CrsToLatLng(crs),
+            get_crs_to_latlng(crs),
             mountains=mountains,
             images=images,
         )
@@ -199,32 +651,214 @@ def mountain_lookup(img_data, gpx_file, plot=False):
     return mountains_3d, images_3d, {}
 
 
-def execute_pov(params):
+def mtn_lookup(pano_filename, gpx_path, interactive):
+    print("Mountain Lookup")
+    print("Pano Filename: ", pano_filename)
+    print("GPX Path: ", gpx_path)
+    print("Interactive: ", interactive)
+    im_data = load_image_data(pano_filename)
+    if im_data is not None:
+        mountains_3d, images_3d, visible_hikes = mountain_lookup(
+            im_data, gpx_path, interactive)
+        gpx = gpx_path.split("/")[-1].split(".")[0]
+        hs = create_hotspots(mountains_3d,
+                             images_3d, visible_hikes)
+        im_data.add_hotspots(gpx, hs)
+        save_image_data(im_data)
+
+
+def create_hotspots(mountains_3d, images_3d, visible_hikes):
+    hotspots = {}
+    mountain_hotpots = {}
+    for mountain in mountains_3d:
+        mountain_hotpots.update(
+            {
+                str(mountain.name): {
+                    "yaw": float(mountain.location_in_3d.yaw),
+                    "pitch": float(mountain.location_in_3d.pitch),
+                    "distance": float(mountain.location_in_3d.distance),
+                    "elevation": mountain.location.elevation,
+                    "url": mountain.link,
+                }
+            }
+        )
+    image_hotpots = {}
+    for image in images_3d:
+        im_data = load_image_data(image.name)
+        if im_data is not None:
+            image_hotpots.update(
+                {
+                    str(image.name): {
+                        "text": image.name[0:-9],
+                        "imageTooltip": f"<div class='panorama-image-div'><img class='panorama-image' src='{im_data.thumbnail_path}'></div>",
+                        "sceneId": image.name,
+                        "yaw": float(image.location_in_3d.yaw),
+                        "pitch": float(image.location_in_3d.pitch),
+                        "distance": float(image.location_in_3d.distance),
+                    }
+                }
+            )
+    hike_hotspots = {}
+    for hike, waypoints in visible_hikes.items():
+        hike_waypoints = []
+        for wp in waypoints:
+            hike_waypoints.append(
+                {
+                    "id": wp.id,
+                    "yaw": float(wp.location_in_3d.yaw),
+                    "pitch": float(wp.location_in_3d.pitch),
+                    "distance": float(wp.location_in_3d.distance),
+                    "elevation": wp.location.elevation,
+                }
+            )
+        hike_hotspots.update(
+            {
+                hike: hike_waypoints
+            }
+        )
+    hotspots.update(
+        {
+            "mountains": mountain_hotpots,
+            "images": image_hotpots,
+            "hikes": hike_hotspots,
+        }
+    )
+    return hotspots
+
+
+# pov_command output options for primary_pov modes that are not data renders
+POV_OUTPUT_MODES = {"height": "color", "texture": "color", "route": "color"}
+
+
+def pov_command(params, extra_options=None):
+    extra_options = extra_options or []
     pov_filename, out_filename, dimensions, mode = params
     out_width, out_height = dimensions
+    if mode == "color":
+        options = [
+            "Output_File_Type=N Bits_Per_Color=16 +Q8 +UR +A",
+            "-GA",
+        ]
+    elif mode == "preview":
+        options = [
+            "Output_File_Type=N Bits_Per_Color=16 +Q2 -A",
+            "-GA",
+        ]
+    else:
+        options = [
+            "Output_File_Type=N Bits_Per_Color=16 Display=off",
+            "-GA",
+            "Antialias=off Quality=0 File_Gamma=1.0",
+        ]
+    return [
+        "povray",
+        "+W%d" % out_width,
+        "+H%d" % out_height,
+        *options,
+        *extra_options,
+        "+I" + pov_filename,
+        "+O" + out_filename,
+    ]
+
+
+def execute_raymarch(dem_file, raster_data, vertical_exaggeration, out_filename, dimensions, mode):
+    p_i("Generating %s" % out_filename)
+    render = render_spherical(
+        dem_file, raster_data, vertical_exaggeration, dimensions, mode)
+    cv2.imwrite(out_filename, to_png_array(render, mode))
+
+
+def execute_raymarch_modes(dem_file, raster_data, vertical_exaggeration, outputs, dimensions):
+    # every mode is shaded from one pass of ray marching
+    p_i("Generating %s" % ", ".join(outputs.values()))
+    renders = render_spherical_modes(
+        dem_file, raster_data, vertical_exaggeration, dimensions, list(outputs))
+    for mode, out_filename in outputs.items():
+        cv2.imwrite(out_filename, to_png_array(renders[mode], mode))
+    return outputs
+
+
+def execute_pov(params):
+    _, out_filename, _, _ = params
     p_i("Generating %s" % out_filename)
-    if mode == "color" or mode == "gradient":
-        subprocess.call(
-            [
-                "povray",
-                "+W%d" % out_width,
-                "+H%d" % out_height,
-                "Output_File_Type=N Bits_Per_Color=16 +Q8 +UR +A",
-                "-GA",
-                "+I" + pov_filename,
-                "+O" + out_filename,
-            ]
+    subprocess.call(pov_command(params))
+
+
+def get_strip_bounds(length, strips, overlap=2, span=None):
+    # pixel ranges (0-indexed, end exclusive) for each strip, padded by
+    # overlap so antialiasing sees the same neighbours as a full render
+    first, last = span if span else (0, length)
+    step = -(-(last - first) // strips)
+    bounds = []
+    for start in range(first, last, step):
+        end = min(start + step, last)
+        bounds.append(
+            (start, end, max(start - overlap, 0), min(end + overlap, length))
         )
-    else:
-        subprocess.call(
-            [
-                "povray",
-                "+W%d" % out_width,
-                "+H%d" % out_height,
-                "Output_File_Type=N Bits_Per_Color=16 Display=off",
-                "-GA",
-                "Antialias=off Quality=0 File_Gamma=1.0",
-                "+I" + pov_filename,
-                "+O" + out_filename,
-            ]
+    return bounds
+
+
+def execute_pov_strip(params, strip, strip_bounds, orientation, threads, workspace):
+    pov_filename, out_filename, dimensions, mode = params
+    _, _, render_start, render_end = strip_bounds
+    strip_filename = f"{workspace}/strip{strip}.png"
+    option = "R" if orientation == "rows" else "C"
+    extra_options = [f"+WT{threads}"]
+    # povray counts rows and columns from 1, values <= 1 are read as fractions
+    if render_start > 0:
+        extra_options.append(f"+S{option}{render_start + 1}")
+    if render_end < dimensions[1 if orientation == "rows" else 0]:
+        extra_options.append(f"+E{option}{render_end}")
+    start_time = time.time()
+    subprocess.call(
+        pov_command(
+            [pov_filename, strip_filename, dimensions, mode], extra_options),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return strip_filename, time.time() - start_time
+
+
+def execute_pov_strips(params, workers=0, orientation="rows", span=None):
+    # span limits the output to those rows or columns of the frame
+    _, out_filename, dimensions, _ = params
+    out_width, out_height = dimensions
+    if workers <= 0:
+        workers = os.cpu_count()
+    length = out_height if orientation == "rows" else out_width
+    first, last = span if span else (0, length)
+    strips = get_strip_bounds(
+        length, min(workers, last - first), span=(first, last))
+    threads = max(os.cpu_count() // len(strips), 1)
+    p_i(f"Generating {out_filename} in {len(strips)} {orientation} strips")
+    with scratch_workspace() as workspace:
+        rendered = Parallel(n_jobs=workers, prefer="threads")(
+            delayed(execute_pov_strip)(
+                params, i, bounds, orientation, threads, workspace)
+            for i, bounds in enumerate(strips)
         )
+
+        strip_images = []
+        for (strip_filename, duration), bounds in zip(rendered, strips):
+            start, end, render_start, render_end = bounds
+            p_i(f"Strip {start}-{end} rendered in {duration:.2f} seconds")
+            im = cv2.imread(strip_filename, cv2.IMREAD_UNCHANGED)
+            if im is None:
+                p_e(f"Strip {start}-{end} of {out_filename} failed to render")
+                return []
+            # povray either writes the full frame or only the rendered region
+            axis = 0 if orientation == "rows" else 1
+            if im.shape[axis] == length:
+                offset = 0
+            else:
+                offset = render_start
+            if orientation == "rows":
+                strip_images.append(im[start - offset:end - offset])
+            else:
+                strip_images.append(im[:, start - offset:end - offset])
+
+    if orientation == "rows":
+        cv2.imwrite(out_filename, np.vstack(strip_images))
+    else:
+        cv2.imwrite(out_filename, np.hstack(strip_images))
+    return [duration for _, duration in rendered]
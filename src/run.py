@@ -1,18 +1,13 @@
 import hashlib
 import os
-import pickle
-import time
 import webbrowser
+from json import load
 from flask import Flask, render_template, request, redirect, session, url_for
 from werkzeug.utils import secure_filename
-from image_handling import (
-    get_exif_gsp_img_direction,
-    reduce_filesize,
-    transform_panorama,
-)
-from renderer import generate_viewshed, mountain_lookup, render_height
+from image_handling import get_exif_gsp_img_direction, reduce_filesize
 from tools.debug import p_i
 from tools.file_handling import (
+    SEEN_HIKES,
     get_files,
     get_seen_items,
     load_image_data,
@@ -20,10 +15,10 @@ from tools.file_handling import (
     remove_with_force,
     reset_image,
     save_image_data,
-    trim_hike,
 )
 from PIL import Image
-from joblib import Parallel, delayed
+from jobs import enqueue, get_job, start_workers
+from location_handler import get_raster_path
 from tools.types import ImageData
 
 
@@ -37,18 +32,24 @@ global DEBUG_LOCATIONS
 DEBUG_LOCATIONS = False
 
 SEEN_IMAGES_PATH = f"{UPLOAD_FOLDER}dev/seen_images.txt"
-SEEN_HIKES = f"{UPLOAD_FOLDER}hikes/"
 
 
-def create_app():
+def create_app(debug=False):
     app = Flask(__name__, static_url_path=f"/{UPLOAD_FOLDER}")
     app.secret_key = "secret key"
     app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
     app.config["MAX_CONTENT_LENGTH"] = 30 * 1024 * 1024
+    reloader_child = os.environ.get("WERKZEUG_RUN_MAIN") == "true"
     # The reloader has not yet run - open the browser
-    if not os.environ.get("WERKZEUG_RUN_MAIN"):
+    if not reloader_child:
         app.logger.info("Opening browser ...")
         webbrowser.open_new('http://localhost:5000/')
+    # only start job workers in the process that serves requests, with the
+    # debug reloader the parent process only watches the files
+    if reloader_child or not (debug or app.debug):
+        # ingest the dem before any job reads it
+        get_raster_path()
+        start_workers(get_job_workers())
 
     @app.route("/", methods=["POST", "GET"])
     def homepage():
@@ -130,6 +131,8 @@ def create_app():
             gpx_path = f"{fp}{filename}"
             session["gpx_path"] = gpx_path
             f.save(gpx_path)
+            # parsed once now, the lookups only read the compiled peaks
+            enqueue("compilegpx", gpx_path=gpx_path)
             return redirect(url_for("homepage"))
 
     @app.route("/uploadhike", methods=["POST", "GET"])
@@ -153,16 +156,8 @@ def create_app():
 
     @app.route("/trimgpx")
     def trimgpx():
-        f = session.get("hike", None)
-        f_hash = hashlib.md5(f.encode("utf-8")).hexdigest()[-8:]
-        fn = f.split("/")[-1].split(".")[0]
-        filename_h = f"{fn}-{f_hash}"
-        make_folder(SEEN_HIKES)
-        trimmed = trim_hike(f)
-        hike_path = f"{SEEN_HIKES}{filename_h}.pkl"
-        pickle.dump([trimmed], open(hike_path, "wb"))
-        os.remove(f)
-        return ("", 204)
+        job_id = enqueue("trimgpx", hike=session.get("hike", None))
+        return {"job_id": job_id}, 202
 
     @app.route("/rmvimg", methods=["GET"])
     def rmvimg():
@@ -189,21 +184,20 @@ def create_app():
 
     @app.route("/rendering")
     def rendering():
-        IMAGE_DATA = load_image_data(get_filename())
-        render_complete = render_height(IMAGE_DATA)
-        if render_complete:
-            return ("", 204)
-        else:
-            return "<h4>Render Failed</h4>"
+        job_id = enqueue("rendering", filename=get_filename())
+        return {"job_id": job_id}, 202
 
     @app.route("/viewshed")
     def viewshed():
-        IMAGE_DATA = load_image_data(get_filename())
-        viewshed_complete = generate_viewshed(IMAGE_DATA)
-        if viewshed_complete:
-            return ("", 204)
-        else:
-            return "<h4>Could Not Create Viewshed</h4>"
+        job_id = enqueue("viewshed", filename=get_filename())
+        return {"job_id": job_id}, 202
+
+    @app.route("/jobs/<job_id>")
+    def job_status(job_id):
+        job = get_job(job_id)
+        if job is None:
+            return {"error": "Unknown job"}, 404
+        return job
 
     # select pano coordinates
     @app.route("/spcoords")
@@ -267,29 +261,44 @@ def create_app():
         if request.method == "POST":
             render_coords = request.form.get("render-coords")
             pano_coords = request.form.get("panorama-coords")
+            render_width = request.form.get("render-width")
             return redirect(
                 url_for(
-                    "transform", render_coords=render_coords, pano_coords=pano_coords
+                    "transform",
+                    render_coords=render_coords,
+                    pano_coords=pano_coords,
+                    render_width=render_width,
                 )
             )
 
     @app.route("/transform", methods=["POST", "GET"])
     def transform():
-        IMAGE_DATA = load_image_data(get_filename())
-        session["filename"] = IMAGE_DATA.filename
-
-        pano_coords = strip_array(request.args.get("pano_coords"), True)
-        render_coords = strip_array(
-            request.args.get("render_coords"), True)
+        session["transform"] = {
+            "pano_coords": strip_array(request.args.get("pano_coords"), True),
+            "render_coords": strip_array(request.args.get("render_coords"), True),
+            "render_width": request.args.get("render_width", type=float),
+        }
+        # waiting for the final render and the crop render run in a job
+        return redirect(
+            url_for(
+                "loading",
+                task="warp",
+                title="Transforming Panorama",
+                text="Transforming Panorama ...",
+                redirect_url=url_for("warped"),
+            )
+        )
 
-        IMAGE_DATA = transform_panorama(
-            IMAGE_DATA, pano_coords, render_coords)
-        if not IMAGE_DATA:
-            return "<h4>Transform failed because of an unequal amount of sample points in the panorama and render ...</h4>"
+    @app.route("/warp")
+    def warp():
+        job_id = enqueue(
+            "transform", filename=get_filename(), **session.get("transform", {}))
+        return {"job_id": job_id}, 202
 
-        save_image_data(IMAGE_DATA)
+    @app.route("/warped")
+    def warped():
+        IMAGE_DATA = load_image_data(get_filename())
         session["filename"] = IMAGE_DATA.filename
-
         mark_image_seen(IMAGE_DATA)
         return render_template(
             "preview_warped.html",
@@ -298,21 +307,6 @@ def create_app():
             pano_id=IMAGE_DATA.filename,
         )
 
-    def mtn_lookup(pano_filename, gpx_path, interactive):
-        print("Mountain Lookup")
-        print("Pano Filename: ", pano_filename)
-        print("GPX Path: ", gpx_path)
-        print("Interactive: ", interactive)
-        im_data = load_image_data(pano_filename)
-        if im_data is not None:
-            mountains_3d, images_3d, visible_hikes = mountain_lookup(
-                im_data, gpx_path, interactive)
-            gpx = gpx_path.split("/")[-1].split(".")[0]
-            hs = create_hotspots(mountains_3d,
-                                 images_3d, visible_hikes)
-            im_data.add_hotspots(gpx, hs)
-            save_image_data(im_data)
-
     @app.route("/findmtns")
     def findmtns():
         gpx_path = session.get("gpx_path", None)
@@ -330,15 +324,9 @@ def create_app():
                 remove_image_as_seen(im)
         fn = i[-1]
         session["filename"] = fn
-        start_time = time.time()
-        Parallel(n_jobs=-1)(
-            delayed(mtn_lookup)(pano_filename, gpx_path, interactive)
-            for pano_filename in i
-        )
-        app.logger.info(
-            f"Duration:  {time.time() - start_time} seconds",
-        )
-        return ("", 204)
+        job_id = enqueue(
+            "findmtns", filenames=i, gpx_path=gpx_path, interactive=interactive)
+        return {"job_id": job_id}, 202
 
     @app.route("/mountains")
     def mountains():
@@ -373,6 +361,14 @@ def create_app():
     return app
 
 
+def get_job_workers():
+    render_settings_path = "render_settings.json"
+    with open(render_settings_path) as json_file:
+        data = load(json_file)
+        json_file.close()
+    return data.get("job_workers", 0)
+
+
 def verify_image_data(im):
     im_data = load_image_data(im)
     if im_data is None:
@@ -464,65 +460,6 @@ def make_scenes(gpx_filename, images=None):
     return scenes
 
 
-def create_hotspots(mountains_3d, images_3d, visible_hikes):
-    hotspots = {}
-    mountain_hotpots = {}
-    for mountain in mountains_3d:
-        mountain_hotpots.update(
-            {
-                str(mountain.name): {
-                    "yaw": float(mountain.location_in_3d.yaw),
-                    "pitch": mountain.location_in_3d.pitch,
-                    "distance": mountain.location_in_3d.distance,
-                    "elevation": mountain.location.elevation,
-                    "url": mountain.link,
-                }
-            }
-        )
-    image_hotpots = {}
-    for image in images_3d:
-        im_data = load_image_data(image.name)
-        if im_data is not None:
-            image_hotpots.update(
-                {
-                    str(image.name): {
-                        "text": image.name[0:-9],
-                        "imageTooltip": f"<div class='panorama-image-div'><img class='panorama-image' src='{im_data.thumbnail_path}'></div>",
-                        "sceneId": image.name,
-                        "yaw": float(image.location_in_3d.yaw),
-                        "pitch": image.location_in_3d.pitch,
-                        "distance": image.location_in_3d.distance,
-                    }
-                }
-            )
-    hike_hotspots = {}
-    for hike, waypoints in visible_hikes.items():
-        hike_waypoints = []
-        for wp in waypoints:
-            hike_waypoints.append(
-                {
-                    "id": wp.id,
-                    "yaw": float(wp.location_in_3d.yaw),
-                    "pitch": wp.location_in_3d.pitch,
-                    "distance": wp.location_in_3d.distance,
-                    "elevation": wp.location.elevation,
-                }
-            )
-        hike_hotspots.update(
-            {
-                hike: hike_waypoints
-            }
-        )
-    hotspots.update(
-        {
-            "mountains": mountain_hotpots,
-            "images": image_hotpots,
-            "hikes": hike_hotspots,
-        }
-    )
-    return hotspots
-
-
 def strip_array(arr, to_pythonic_list=False):
     arr = [x.replace("[", "").replace("]", "") for x in arr.split("],")]
     a = []
@@ -536,6 +473,6 @@ def strip_array(arr, to_pythonic_list=False):
 
 
 if __name__ == "__main__":
-    app = create_app()
+    app = create_app(debug=True)
     app.run(host="localhost", port=5000, debug=True)
     # main()
@@ -22,3 +22,28 @@ function getSampleNumber() {
     NUMBER_OF_SAMPLES = 4
     return NUMBER_OF_SAMPLES
 }
+
+function waitForJob(response, onProgress) {
+    // resolves with the finished job once the queued task is done
+    return response.json().then(function (data) {
+        return new Promise(function (resolve, reject) {
+            function poll() {
+                fetch('/jobs/' + data.job_id)
+                    .then((r) => r.json())
+                    .then(function (job) {
+                        if (onProgress) {
+                            onProgress(job.progress)
+                        }
+                        if (job.status === 'done') {
+                            resolve(job)
+                        } else if (job.status === 'failed') {
+                            reject(job)
+                        } else {
+                            setTimeout(poll, 1000)
+                        }
+                    })
+            }
+            poll()
+        })
+    })
+}
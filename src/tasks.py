@@ -0,0 +1,103 @@
+import hashlib
+import os
+import pickle
+import time
+from joblib import Parallel, delayed
+from PIL import Image
+from image_handling import overlay_crop_render, transform_panorama
+from jobs import Requeue, set_progress
+from renderer import (
+    final_render_queued,
+    generate_viewshed,
+    mtn_lookup,
+    render_crop,
+    render_height,
+    render_queued_final,
+    share_lookup_rasters,
+    share_peak_index,
+)
+from tools.debug import p_i
+from tools.file_handling import SEEN_HIKES, load_image_data, make_folder, save_image_data, trim_hike
+
+
+def rendering(job_id, filename):
+    IMAGE_DATA = load_image_data(filename)
+    render_complete = render_height(IMAGE_DATA)
+    if not render_complete and not os.path.exists(IMAGE_DATA.render_path):
+        raise Exception("Render Failed")
+    return {"render_path": IMAGE_DATA.render_path}
+
+
+def renderfinal(job_id, filename, render_shape=None):
+    IMAGE_DATA = load_image_data(filename)
+    if not render_queued_final(IMAGE_DATA, render_shape):
+        raise Exception("Final Render Failed")
+    return {"render_path": IMAGE_DATA.render_path}
+
+
+def transform(job_id, filename, pano_coords, render_coords, render_width=None):
+    IMAGE_DATA = load_image_data(filename)
+    # points may have been picked in the preview render, scale them to
+    # the final render once it has replaced the preview. the final render
+    # job needs a worker too, so this one is not kept waiting on it
+    if final_render_queued(IMAGE_DATA):
+        raise Requeue()
+    if render_width:
+        with Image.open(IMAGE_DATA.render_path) as img:
+            scale = img.size[0] / render_width
+        render_coords = [(x * scale, y * scale) for x, y in render_coords]
+
+    IMAGE_DATA = transform_panorama(IMAGE_DATA, pano_coords, render_coords)
+    if not IMAGE_DATA:
+        raise Exception(
+            "Transform failed because of an unequal amount of sample points "
+            "in the panorama and render")
+    set_progress(job_id, 50)
+    if render_crop(IMAGE_DATA):
+        overlay_crop_render(IMAGE_DATA)
+    save_image_data(IMAGE_DATA)
+    return {"filename": IMAGE_DATA.filename}
+
+
+def viewshed(job_id, filename):
+    IMAGE_DATA = load_image_data(filename)
+    viewshed_complete = generate_viewshed(IMAGE_DATA)
+    if not viewshed_complete:
+        raise Exception("Could Not Create Viewshed")
+    return {"filename": IMAGE_DATA.filename}
+
+
+def findmtns(job_id, filenames, gpx_path, interactive):
+    start_time = time.time()
+    share_peak_index(gpx_path)
+    batch_size = os.cpu_count()
+    for i in range(0, len(filenames), batch_size):
+        for pano_filename in filenames[i:i + batch_size]:
+            IMAGE_DATA = load_image_data(pano_filename)
+            if IMAGE_DATA is not None:
+                share_lookup_rasters(IMAGE_DATA)
+        Parallel(n_jobs=-1)(
+            delayed(mtn_lookup)(pano_filename, gpx_path, interactive)
+            for pano_filename in filenames[i:i + batch_size]
+        )
+        set_progress(
+            job_id, 100 * min(i + batch_size, len(filenames)) / len(filenames))
+    p_i(f"Duration:  {time.time() - start_time} seconds")
+    return {"images": len(filenames)}
+
+
+def compilegpx(job_id, gpx_path):
+    share_peak_index(gpx_path)
+    return {"gpx_path": gpx_path}
+
+
+def trimgpx(job_id, hike):
+    f_hash = hashlib.md5(hike.encode("utf-8")).hexdigest()[-8:]
+    fn = hike.split("/")[-1].split(".")[0]
+    filename_h = f"{fn}-{f_hash}"
+    make_folder(SEEN_HIKES)
+    trimmed = trim_hike(hike)
+    hike_path = f"{SEEN_HIKES}{filename_h}.pkl"
+    pickle.dump([trimmed], open(hike_path, "wb"))
+    os.remove(hike)
+    return {"hike_path": hike_path}
@@ -1,29 +1,29 @@
 from math import radians, asin, atan2
-import rasterio
-from rasterio.warp import transform
-from functools import reduce
-import operator
 from numpy import sin, cos, degrees
 
 # constants
 EARTH_RADIUS = 6378.1
+# povray maps the 16 bit heightfield png onto [0, 1] and lifts it slightly,
+# see the height_field translate in povs.primary_pov
+HEIGHT_FIELD_RANGE = 65535
+HEIGHT_FIELD_OFFSET = 0.00025
 
 
 def get_earth_radius():
     return EARTH_RADIUS
 
 
-def convert_single_coordinate_pair(bounds, converter, lat, lon):
+def convert_coordinate_pairs(bounds, converter, lats, lons):
+    # every pair through the converter in one call, scaled to [0, 1] of bounds
     min_x, min_y, max_x, max_y = bounds
-    coordinate_pair = converter.convert(lat, lon)
-    polar_lat = coordinate_pair.GetX()
-    polar_lon = coordinate_pair.GetY()
-    lat_scaled = (polar_lat - min_x) / (max_x - min_x)
-    lon_scaled = (polar_lon - min_y) / (max_y - min_y)
-    return [lat_scaled, lon_scaled]
+    xs, ys = converter.convert_many(lats, lons)
+    lats_scaled = (xs - min_x) / (max_x - min_x)
+    lons_scaled = (ys - min_y) / (max_y - min_y)
+    return [[lat, lon] for lat, lon in zip(lats_scaled.tolist(), lons_scaled.tolist())]
 
 
 def convert_coordinates(raster, converter, lat, lon, va, get_height=False):
+    # raster is a tools.raster.RasterAccessor
     b = raster.bounds
     min_x, min_y, max_x, max_y = b.left, b.bottom, b.right, b.top
     coordinate_pair = converter.convert(lat, lon)
@@ -33,31 +33,24 @@ def convert_coordinates(raster, converter, lat, lon, va, get_height=False):
     lat_scaled = (polar_lat - min_x) / (max_x - min_x)
     lon_scaled = (polar_lon - min_y) / (max_y - min_y)
 
-    to_crs = raster.crs
-    from_crs = rasterio.crs.CRS.from_epsg(4326)
-    new_x, new_y = reduce(operator.add, transform(
-        from_crs, to_crs, [lon], [lat]))
-    row, col = raster.index(new_x, new_y)
-    h = raster.read(1)
-    try:
-        height = h[row, col]
-    except IndexError:
+    height = raster.sample(polar_lat, polar_lon)
+    if height is None:
         return None
 
     if get_height:
         return height
 
-    h_avg = [h[x, y] for x in range(row - 1, row + 2)
-             for y in range(col - 1, col + 2)]
-    h_avg = sum(h_avg) / len(h_avg)
+    h_avg = raster.neighbourhood(polar_lat, polar_lon)
+    h_avg = height if h_avg is None else h_avg.mean()
 
     bbox = raster.bounds
+    h_min = raster.min
 
     def scale_height(height):
-        return (((height - h.min()) / ((bbox.right - bbox.left) + (bbox.top - bbox.bottom) - h.min())) * va)
+        return (((height - h_min) / ((bbox.right - bbox.left) + (bbox.top - bbox.bottom) - h_min)) * va)
 
     height_scaled = scale_height(max(height, h_avg))
-    height_max_mountain_scaled = scale_height(h.max())
+    height_max_mountain_scaled = scale_height(raster.max)
 
     return [
         lat_scaled,
@@ -0,0 +1,54 @@
+import os
+import threading
+import cv2
+import numpy as np
+from tools.converters import HEIGHT_FIELD_OFFSET, HEIGHT_FIELD_RANGE
+
+
+def get_camera_position(bounds, raster_data, vertical_exaggeration):
+    # camera in dem crs and meters, undoing the scaling in get_raster_data
+    min_x, min_y, max_x, max_y = bounds
+    location_x, location_height, location_y = raster_data[0][:3]
+    return [
+        min_x + location_x * (max_x - min_x),
+        min_y + location_y * (max_y - min_y),
+        (location_height / vertical_exaggeration - HEIGHT_FIELD_OFFSET)
+        * HEIGHT_FIELD_RANGE,
+    ]
+
+
+def save_coordinate_buffer(render_filename, buffer_filename, bounds, crs, camera):
+    # render_filename is a 16 bit png from the coordinates mode, red and
+    # green are the dem x and y scaled to bounds and blue the height field,
+    # which the height field offset keeps above zero wherever terrain was hit
+    render = cv2.imread(render_filename, cv2.IMREAD_UNCHANGED)
+    if render is None or render.ndim != 3:
+        return False
+    blue, green, red = np.moveaxis(render[:, :, :3], -1, 0)
+    hit = blue > 0
+    min_x, min_y, max_x, max_y = bounds
+    x = min_x + red / HEIGHT_FIELD_RANGE * (max_x - min_x)
+    y = min_y + green / HEIGHT_FIELD_RANGE * (max_y - min_y)
+    elevation = (blue / HEIGHT_FIELD_RANGE - HEIGHT_FIELD_OFFSET) * HEIGHT_FIELD_RANGE
+    distance = np.sqrt(
+        (x - camera[0]) ** 2 + (y - camera[1]) ** 2 + (elevation - camera[2]) ** 2
+    )
+    # whole meters are enough for both, and keep the buffer at 16 bits
+    elevation = np.rint(np.clip(elevation, 0, HEIGHT_FIELD_RANGE))
+    distance = np.rint(np.clip(distance, 0, HEIGHT_FIELD_RANGE))
+    # written next to the buffer and swapped in, never truncated in place
+    tmp_filename = f"{buffer_filename}.{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_filename, "wb") as buffer_file:
+        np.savez_compressed(
+            buffer_file,
+            x=np.where(hit, red, 0),
+            y=np.where(hit, green, 0),
+            elevation=np.where(hit, elevation, 0).astype(np.uint16),
+            distance=np.where(hit, distance, 0).astype(np.uint16),
+            hit=hit,
+            bounds=np.array(bounds, dtype=np.float64),
+            crs=np.array(crs),
+            camera=np.array(camera, dtype=np.float64),
+        )
+    os.replace(tmp_filename, buffer_filename)
+    return True
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import cv2
+import numpy as np
+import rasterio
+from rasterio.windows import from_bounds
+from tools.converters import HEIGHT_FIELD_RANGE
+from tools.debug import p_i
+from tools.dem_tiles import get_tile_index, read_mosaic_window
+from tools.workspace import move_file, scratch_workspace
+
+
+def get_crop_key(dem_file, tile_x, tile_y, radius, tile_size):
+    dem_stat = os.stat(dem_file)
+    dem_id = hashlib.sha256(
+        f"{os.path.abspath(dem_file)}:{dem_stat.st_size}:{int(dem_stat.st_mtime)}"
+        .encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{dem_id}-{int(radius)}-{int(tile_size)}-{tile_x}-{tile_y}"
+
+
+def get_crop_bounds(tile_x, tile_y, radius, tile_size):
+    # the crop covers radius around every point of the tile, so all cameras
+    # snapped to it keep at least radius of terrain on each side
+    center_x = (tile_x + 0.5) * tile_size
+    center_y = (tile_y + 0.5) * tile_size
+    half_size = radius + tile_size / 2
+    return [
+        center_x - half_size,
+        center_y - half_size,
+        center_x + half_size,
+        center_y + half_size,
+    ]
+
+
+def read_dem_window(dem_file, bounds):
+    # masked band, transform and crs of the dem under bounds. a mosaic only
+    # opens the tiles its index puts under the window
+    tile_index = get_tile_index(dem_file)
+    if tile_index is not None:
+        return read_mosaic_window(tile_index, bounds)
+    min_x, min_y, max_x, max_y = bounds
+    with rasterio.open(dem_file) as src:
+        window = from_bounds(min_x, min_y, max_x, max_y, src.transform)
+        window = window.round_offsets().round_lengths()
+        band = src.read(1, window=window, boundless=True, masked=True)
+        return band, src.window_transform(window), src.crs
+
+
+def write_crop(dem_file, bounds, tif_filename, png_filename):
+    # one windowed read, the geotiff and the png povray reads are written
+    # from the same buffer
+    band, transform, crs = read_dem_window(dem_file, bounds)
+    # same clamping as gdal_translate -ot UInt16, nodata becomes sea level
+    heights = np.clip(
+        np.rint(band.filled(0)), 0, HEIGHT_FIELD_RANGE).astype(np.uint16)
+    profile = {
+        "driver": "GTiff",
+        "width": heights.shape[1],
+        "height": heights.shape[0],
+        "count": 1,
+        "dtype": "uint16",
+        "crs": crs,
+        "transform": transform,
+    }
+    with rasterio.open(tif_filename, "w", **profile) as dst:
+        dst.write(heights, 1)
+    cv2.imwrite(png_filename, heights)
+
+
+def get_crop(dem_file, x, y, radius, cache_folder, tile_size=1000, max_size_mb=1024):
+    # x and y are the camera in the dem crs, nearby cameras share a crop
+    tile_x, tile_y = int(x // tile_size), int(y // tile_size)
+    key = get_crop_key(dem_file, tile_x, tile_y, radius, tile_size)
+    crop_tif = f"{cache_folder}/{key}.tif"
+    crop_png = f"{cache_folder}/{key}.png"
+    if os.path.exists(crop_tif) and os.path.exists(crop_png):
+        # mark as recently used for the lru eviction
+        os.utime(crop_tif)
+        os.utime(crop_png)
+        p_i(f"Crop cache hit for {key}")
+        return crop_tif
+
+    os.makedirs(cache_folder, exist_ok=True)
+    bounds = get_crop_bounds(tile_x, tile_y, radius, tile_size)
+    with scratch_workspace() as workspace:
+        write_crop(dem_file, bounds,
+                   f"{workspace}/crop.tif", f"{workspace}/crop.png")
+        # the tif goes last, it marks the crop as complete
+        move_file(f"{workspace}/crop.png", crop_png)
+        move_file(f"{workspace}/crop.tif", crop_tif)
+    evict_crops(cache_folder, max_size_mb * 1024 * 1024, keep=key)
+    return crop_tif
+
+
+def evict_crops(cache_folder, max_bytes, keep=None):
+    crops = {}
+    for f in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, f)
+        # the tif, png and the raster exports of a crop share its key
+        key = f.split(".")[0]
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        last_used, size, paths = crops.get(key, (0, 0, []))
+        crops[key] = (max(last_used, stat.st_mtime), size + stat.st_size, paths + [path])
+    total = sum(size for _, size, _ in crops.values())
+    for key, (_, size, paths) in sorted(crops.items(), key=lambda c: c[1][0]):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for path in paths:
+            os.remove(path)
+        total -= size
+        p_i(f"Evicted crop {key}")
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as raster_copy
+from tools.debug import p_i
+from tools.workspace import move_file, scratch_workspace
+
+
+def get_source_signature(dem_path):
+    dem_stat = os.stat(dem_path)
+    return {
+        "source": os.path.abspath(dem_path),
+        "size": dem_stat.st_size,
+        "mtime": int(dem_stat.st_mtime),
+    }
+
+
+def get_ingested_paths(dem_path, cache_folder):
+    # tiles of the same name in different folders get their own copies
+    path_hash = hashlib.sha256(os.path.abspath(dem_path).encode("utf-8")).hexdigest()
+    name = f"{os.path.splitext(os.path.basename(dem_path))[0]}-{path_hash[:12]}"
+    return f"{cache_folder}/{name}.tif", f"{cache_folder}/{name}.json"
+
+
+def get_dem_statistics(dem_file):
+    # exact min/max over the full resolution, one internal tile at a time
+    with rasterio.open(dem_file) as ds_raster:
+        minimum, maximum = np.inf, -np.inf
+        for _, window in ds_raster.block_windows(1):
+            band = ds_raster.read(1, window=window, masked=True)
+            if band.count():
+                minimum = min(minimum, float(band.min()))
+                maximum = max(maximum, float(band.max()))
+        return {
+            "min": minimum if np.isfinite(minimum) else None,
+            "max": maximum if np.isfinite(maximum) else None,
+            "nodata": ds_raster.nodata,
+            "crs": int(ds_raster.crs.to_authority()[1]),
+            "bounds": list(ds_raster.bounds),
+            "shape": list(ds_raster.shape),
+        }
+
+
+def ingest_dem(dem_path, cache_folder="data/cache/dem"):
+    # converts the configured dem to a tiled, compressed cloud optimized
+    # geotiff with overviews once, and again only when the source changes
+    cog_path, stats_path = get_ingested_paths(dem_path, cache_folder)
+    signature = get_source_signature(dem_path)
+    if os.path.exists(cog_path) and os.path.exists(stats_path):
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file)
+        if all(stats.get(key) == value for key, value in signature.items()):
+            return cog_path
+
+    p_i(f"Converting {dem_path} to a cloud optimized GeoTIFF")
+    os.makedirs(cache_folder, exist_ok=True)
+    with scratch_workspace() as workspace:
+        tmp_cog = f"{workspace}/dem.tif"
+        with rasterio.open(dem_path) as src:
+            float_data = np.dtype(src.dtypes[0]).kind == "f"
+        raster_copy(
+            dem_path,
+            tmp_cog,
+            driver="COG",
+            BLOCKSIZE=512,
+            COMPRESS="DEFLATE",
+            PREDICTOR="FLOATING_POINT" if float_data else "STANDARD",
+            OVERVIEWS="AUTO",
+            RESAMPLING=Resampling.average.name.upper(),
+            BIGTIFF="IF_SAFER",
+            NUM_THREADS="ALL_CPUS",
+        )
+        stats = {**signature, **get_dem_statistics(tmp_cog)}
+        tmp_stats = f"{workspace}/dem.json"
+        with open(tmp_stats, "w") as stats_file:
+            json.dump(stats, stats_file, indent=4)
+        # the sidecar goes last, it marks the conversion as complete
+        move_file(tmp_cog, cog_path)
+        move_file(tmp_stats, stats_path)
+    p_i(f"DEM ready at {cog_path}")
+    return cog_path
+
+
+def load_dem_statistics(dem_file):
+    stats_path = f"{os.path.splitext(dem_file)[0]}.json"
+    try:
+        with open(stats_path) as stats_file:
+            return json.load(stats_file)
+    except FileNotFoundError:
+        return get_dem_statistics(dem_file)
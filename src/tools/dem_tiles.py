@@ -0,0 +1,122 @@
+import json
+import os
+import numpy as np
+import rasterio
+from osgeo import gdal
+from rasterio.merge import merge
+from tools.dem_ingest import ingest_dem, load_dem_statistics
+from tools.debug import p_i
+from tools.workspace import move_file, scratch_workspace
+
+DEM_EXTENSIONS = (".tif", ".tiff", ".dem", ".asc", ".img", ".hgt", ".vrt")
+
+
+def list_dem_tiles(dem_path):
+    # dem_path in render_settings.json is a file, a folder of tiles or a
+    # list of tiles
+    if isinstance(dem_path, (list, tuple)):
+        return list(dem_path)
+    if os.path.isdir(dem_path):
+        return sorted(
+            os.path.join(dem_path, f)
+            for f in os.listdir(dem_path)
+            if f.lower().endswith(DEM_EXTENSIONS)
+        )
+    return [dem_path]
+
+
+def get_tile_index_path(mosaic_path):
+    return f"{os.path.splitext(mosaic_path)[0]}-tiles.json"
+
+
+def ingest_dem_source(dem_path, cache_folder="data/cache/dem"):
+    # a single dem is used as is, tiles are ingested one by one and put
+    # together in a virtual mosaic with an index over their footprints
+    tiles = list_dem_tiles(dem_path)
+    if len(tiles) == 1:
+        return ingest_dem(tiles[0], cache_folder)
+    if not tiles:
+        raise Exception(f"No DEM tiles found in {dem_path}")
+
+    ingested = [os.path.abspath(ingest_dem(tile, cache_folder)) for tile in tiles]
+    mosaic_path = f"{cache_folder}/mosaic.vrt"
+    index_path = get_tile_index_path(mosaic_path)
+    signature = [[path, os.stat(path).st_mtime_ns] for path in ingested]
+    if os.path.exists(mosaic_path) and os.path.exists(index_path):
+        with open(index_path) as index_file:
+            if json.load(index_file).get("signature") == signature:
+                return mosaic_path
+
+    p_i(f"Building DEM mosaic of {len(ingested)} tiles")
+    footprints = []
+    crs = None
+    for path in ingested:
+        stats = load_dem_statistics(path)
+        if crs is not None and stats["crs"] != crs:
+            raise Exception(f"DEM tile {path} is not in EPSG:{crs}")
+        crs = stats["crs"]
+        footprints.append({"path": path, "bounds": stats["bounds"]})
+    with scratch_workspace() as workspace:
+        tmp_mosaic = f"{workspace}/mosaic.vrt"
+        mosaic = gdal.BuildVRT(tmp_mosaic, ingested)
+        mosaic.FlushCache()
+        # closing the dataset writes the vrt
+        mosaic = None
+        tmp_index = f"{workspace}/mosaic-tiles.json"
+        with open(tmp_index, "w") as index_file:
+            json.dump(
+                {"signature": signature, "crs": crs, "tiles": footprints},
+                index_file,
+            )
+        # the index goes last, it marks the mosaic as complete
+        move_file(tmp_mosaic, mosaic_path)
+        move_file(tmp_index, index_path)
+    return mosaic_path
+
+
+class TileIndex:
+    def __init__(self, index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        self.crs = index["crs"]
+        self.paths = [tile["path"] for tile in index["tiles"]]
+        self.bounds = np.array(
+            [tile["bounds"] for tile in index["tiles"]], dtype=np.float64)
+
+    def query(self, bounds):
+        # tiles whose footprint intersects the left, bottom, right, top box
+        left, bottom, right, top = bounds
+        hits = (
+            (self.bounds[:, 0] < right)
+            & (self.bounds[:, 2] > left)
+            & (self.bounds[:, 1] < top)
+            & (self.bounds[:, 3] > bottom)
+        )
+        return [self.paths[i] for i in np.flatnonzero(hits)]
+
+
+def get_tile_index(dem_file):
+    # None when dem_file is a single raster and not a mosaic
+    index_path = get_tile_index_path(dem_file)
+    if not dem_file.endswith(".vrt") or not os.path.exists(index_path):
+        return None
+    return TileIndex(index_path)
+
+
+def read_mosaic_window(tile_index, bounds):
+    # assembles only the tiles under bounds, so the cost follows the window
+    # and not the coverage of the mosaic
+    tiles = tile_index.query(bounds)
+    if not tiles:
+        raise Exception(f"No DEM tiles cover {bounds}")
+    datasets = [rasterio.open(tile) for tile in tiles]
+    try:
+        nodata = datasets[0].nodata
+        band, transform = merge(datasets, bounds=bounds, indexes=[1])
+        crs = datasets[0].crs
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    band = band[0]
+    mask = np.zeros(band.shape, dtype=bool) if nodata is None else band == nodata
+    return np.ma.masked_array(band, mask=mask), transform, crs
@@ -1,5 +1,5 @@
 import pickle
-from subprocess import call
+from json import load
 import numpy as np
 from tools.debug import p_a, p_i, p_in, p_line, p_e
 import os
@@ -8,9 +8,14 @@ import gpxpy
 import rasterio
 import image_handling
 import location_handler
-from tools.types import Hike, ImageInSight, LatLngToCrs, Location, Mountain, Waypoint
+from tools.dem_crop import get_crop
+from tools.peak_index import open_peak_index
+from tools.raster import sample_raster
+from tools.types import Hike, ImageInSight, Location, Waypoint, get_latlng_to_crs
 from rdp import rdp
 
+SEEN_HIKES = "src/static/hikes/"
+
 
 def get_mountain_data(dem_file, im_data, gradient=False):
     panorama_path = im_data.path
@@ -30,33 +35,30 @@ def get_mountain_data(dem_file, im_data, gradient=False):
         camera_lat, camera_lon, deg=viewing_direction
     )
     coordinates = [camera_lat, camera_lon, *look_ats]
-    cropped_dem = f"data/rasters/cropped-{im_data.filename}.tif"
 
-    src = rasterio.open(dem_file)
-    crs = int(src.crs.to_authority()[1])
-    converter = LatLngToCrs(crs)
+    with open("render_settings.json") as json_file:
+        data = load(json_file)
+        cache_folder = data.get("crop_cache_path", "data/cache/crops")
+        tile_size = data.get("crop_tile_size", 1000)
+        cache_size_mb = data.get("crop_cache_size_mb", 1024)
+        json_file.close()
+
+    with rasterio.open(dem_file) as src:
+        crs = int(src.crs.to_authority()[1])
+    converter = get_latlng_to_crs(crs)
     camera_placement_crs = converter.convert(camera_lat, camera_lon)
 
     displacement_distance = 15000  # in meters from camera placement
 
-    westernmost_point = camera_placement_crs.GetX() - displacement_distance
-    northernmost_point = camera_placement_crs.GetY() + displacement_distance
-    easternmost_point = camera_placement_crs.GetX() + displacement_distance
-    southernmost_point = camera_placement_crs.GetY() - displacement_distance
-
-    minx, miny = westernmost_point, southernmost_point
-    maxx, maxy = easternmost_point, northernmost_point
-
-    call(['gdal_translate', '-ot', 'UInt16',
-          '-projwin', str(minx), str(maxy), str(maxx), str(miny),
-          '--config', 'GDAL_CACHEMAX', '1024',
-          dem_file, cropped_dem])
-
-    cropped_dem_png = f"data/rasters/cropped-{im_data.filename}.png"
-    call(['gdal_translate', '-ot', 'UInt16',
-          '-projwin', str(minx), str(maxy), str(maxx), str(miny),
-          '--config', 'GDAL_CACHEMAX', '1024',
-          dem_file, cropped_dem_png])
+    cropped_dem = get_crop(
+        dem_file,
+        camera_placement_crs.GetX(),
+        camera_placement_crs.GetY(),
+        displacement_distance,
+        cache_folder,
+        tile_size,
+        cache_size_mb,
+    )
 
     return cropped_dem, coordinates, image_location
 
@@ -81,59 +83,81 @@ def read_hike_gpx(gpx_path):
 
 
 def trim_hike(gpx_file):
-    ds_raster = rasterio.open(location_handler.get_raster_path())
-    crs = int(ds_raster.crs.to_authority()[1])
-    converter = LatLngToCrs(crs)
+    dem_file = location_handler.get_raster_path()
+    with rasterio.open(dem_file) as ds_raster:
+        crs = int(ds_raster.crs.to_authority()[1])
     gpx_f = open(gpx_file, "r")
     gpx = gpxpy.parse(gpx_f)
-    locations = [
-        [k.latitude, k.longitude, k.elevation]
+    points = [
+        k
         for i in gpx.tracks
         for j in i.segments
         for k in j.points
     ]
+    if not points:
+        return Hike(gpx_file.split("/")[-1], [])
+    lats = [k.latitude for k in points]
+    lons = [k.longitude for k in points]
+    # track points without an elevation get theirs from the dem
+    xs, ys = get_latlng_to_crs(crs).convert_many(lats, lons)
+    heights = sample_raster(dem_file, xs, ys, bilinear=True)
+    locations = [
+        [k.latitude, k.longitude,
+         k.elevation if k.elevation is not None else float(np.nan_to_num(h))]
+        for k, h in zip(points, heights)
+    ]
     trimmed = rdp(locations, epsilon=0.001)
+    xs, ys = get_latlng_to_crs(crs).convert_many(
+        [val[0] for val in trimmed], [val[1] for val in trimmed])
     fn = gpx_file.split("/")[-1].split(".")[0]
     return Hike(gpx_file.split("/")[-1], [
-        Waypoint(f"{fn}{i}",
-                 Location(*val),
-                 np.array((converter.convert(*val).GetPoints()[0])))
-        for i, val in enumerate(trimmed)
+        Waypoint(f"{fn}{i}", Location(*val), np.array((x, y)))
+        for i, (val, x, y) in enumerate(zip(trimmed, xs, ys))
     ])
 
 
-def read_mountain_gpx(gpx_path, converter):
-    try:
-        gpx_file = open(gpx_path, "r")
-    except FileNotFoundError:
+def read_mountain_gpx(gpx_path, converter, cache_folder="data/cache/peaks"):
+    # every peak, from the compiled peak index of the gpx file
+    if not os.path.exists(gpx_path):
         return []
-    gpx = gpxpy.parse(gpx_file)
-    mountains = []
-    for i in gpx.waypoints:
-        loc = Location(i.latitude, i.longitude, i.elevation)
-        p = converter.convert(loc.latitude, loc.longitude, loc.elevation)
-        loc2d = np.array((p.GetX(), p.GetY()))
-        mountains.append(Mountain(i.name, loc, loc2d, link=i.link))
-    return mountains
+    peak_index = open_peak_index(gpx_path, converter.crs, cache_folder)
+    return peak_index.mountains(range(len(peak_index)))
 
 
-def read_image_locations(filename, image_folder, ds_raster, converter):
-    locs = []
+def read_mountains_near(gpx_path, crs, x, y, radius, cache_folder="data/cache/peaks"):
+    # only the peaks within radius of x, y in crs, through the peak index
+    # of the gpx file instead of parsing and projecting all of it
+    if not os.path.exists(gpx_path):
+        return []
+    peak_index = open_peak_index(gpx_path, crs, cache_folder)
+    return peak_index.mountains(peak_index.query(x, y, radius))
+
+
+def read_image_locations(filename, image_folder, ds_raster):
+    # ds_raster is a tools.raster.RasterAccessor
+    images = []
     seen_images = get_seen_items('images')
     for image in seen_images:
         if image == filename:
             continue
         im_path = f"{image_folder}/{image}/{image}.jpg"
-        t_im_path = f"{image_folder}/{image}/{image}-thumbnail.jpg"
         loc = image_handling.get_exif_gps_latlon(im_path)
-        height = location_handler.get_height_from_raster(
-            loc, ds_raster, converter)
-        if not height:
+        if loc:
+            images.append((image, loc))
+    if not images:
+        return []
+
+    lats = [loc.latitude for _, loc in images]
+    lons = [loc.longitude for _, loc in images]
+    xs, ys = get_latlng_to_crs(ds_raster.crs).convert_many(lats, lons)
+    heights = ds_raster.sample_many(xs, ys)
+    locs = []
+    for (image, loc), x, y, height in zip(images, xs, ys, heights):
+        if np.isnan(height) or not height:
             continue
+        t_im_path = f"{image_folder}/{image}/{image}-thumbnail.jpg"
         loc = Location(loc.latitude, loc.longitude, height)
-        p = converter.convert(loc.latitude, loc.longitude, loc.elevation)
-        locs.append(ImageInSight(image, t_im_path, loc,
-                    np.array((p.GetX(), p.GetY()))))
+        locs.append(ImageInSight(image, t_im_path, loc, np.array((x, y))))
     return locs
 
 
@@ -238,11 +262,16 @@ def reset_image(im):
         os.remove(IMAGE_DATA.warped_panorama_path)
     except (AttributeError, FileNotFoundError):
         pass
+    try:
+        os.remove(IMAGE_DATA.crop_render_path)
+    except (AttributeError, FileNotFoundError, TypeError):
+        pass
     IMAGE_DATA.view_direction = None
     IMAGE_DATA.fov_l = None
     IMAGE_DATA.fov_r = None
     IMAGE_DATA.location = None
     IMAGE_DATA.transform_matrix = None
+    IMAGE_DATA.render_bbox = None
     save_image_data(IMAGE_DATA)
 
 
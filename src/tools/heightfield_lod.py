@@ -0,0 +1,94 @@
+from math import ceil, floor, radians
+import cv2
+import numpy as np
+
+LOD_MAX_LEVELS = 6
+
+
+def get_pixel_angle(dimensions, angle=(360, 180)):
+    # radians covered by one output pixel of the spherical camera
+    return radians(angle[0]) / dimensions[0]
+
+
+def pool_heights(heights, factor):
+    # the highest height within half a coarse cell of every pixel, so peaks
+    # and ridges keep their height in the coarse level and skylines do not sink
+    if factor == 1:
+        return heights
+    kernel = np.ones((factor + 1, factor + 1), dtype=np.uint8)
+    return cv2.dilate(heights, kernel)
+
+
+def get_level_window(center, reach, snap, last):
+    # first and last index of the level, on multiples of snap so the edges
+    # lie on the grid of the next, coarser level too
+    start = max(floor((center - reach) / snap) * snap, 0)
+    end = min(ceil((center + reach) / snap) * snap, last)
+    return start, end
+
+
+def build_lod_heightfield(dem_file, raster_data, pixel_angle, folder, max_levels=LOD_MAX_LEVELS):
+    # nested height fields around the camera, full resolution close by and
+    # halving the resolution each time a dem cell would cover less than half
+    # an output pixel. returns None when one level covers the whole crop
+    heights = cv2.imread(dem_file.replace(".tif", ".png"), cv2.IMREAD_UNCHANGED)
+    rows, cols = heights.shape
+    location_x, _, location_y = raster_data[0][:3]
+    camera_col = location_x * (cols - 1)
+    camera_row = (1 - location_y) * (rows - 1)
+
+    levels = []
+    hole = None
+    for level in range(max_levels):
+        factor = 2 ** level
+        last_col = (cols - 1) // factor * factor
+        last_row = (rows - 1) // factor * factor
+        if level == max_levels - 1:
+            window = (0, last_col, 0, last_row)
+        else:
+            # the next level is used from where its cells span a pixel
+            reach = 2 * factor / pixel_angle
+            window = (
+                *get_level_window(camera_col, reach, 2 * factor, last_col),
+                *get_level_window(camera_row, reach, 2 * factor, last_row),
+            )
+        col_start, col_end, row_start, row_end = window
+        if level == 0 and window == (0, last_col, 0, last_row):
+            return None
+
+        # pooling needs the neighbours just outside the window as well
+        pad = factor // 2
+        top, left = max(row_start - pad, 0), max(col_start - pad, 0)
+        pooled = pool_heights(
+            heights[top:row_end + pad + 1, left:col_end + pad + 1], factor)
+        level_heights = pooled[
+            row_start - top:row_end - top + 1:factor,
+            col_start - left:col_end - left + 1:factor,
+        ]
+        level_file = f"{folder}/lod{level}.png"
+        cv2.imwrite(level_file, np.ascontiguousarray(level_heights))
+
+        # height field space, x along the columns and z from the bottom up
+        bounds = (
+            col_start / (cols - 1),
+            1 - row_end / (rows - 1),
+            col_end / (cols - 1),
+            1 - row_start / (rows - 1),
+        )
+        levels.append({"file": level_file, "bounds": bounds, "hole": hole})
+        if window == (0, last_col, 0, last_row):
+            break
+        hole = bounds
+    return levels
+
+
+def get_skyline(coordinates_render):
+    # topmost terrain row per column of a coordinates render, where blue is
+    # above zero wherever terrain was hit, and the height for empty columns
+    hit = coordinates_render[:, :, 0] > 0
+    return np.where(hit.any(axis=0), hit.argmax(axis=0), hit.shape[0])
+
+
+def compare_skylines(full_render, lod_render):
+    # largest skyline shift in pixels between two coordinates renders
+    return int(np.abs(get_skyline(full_render) - get_skyline(lod_render)).max())
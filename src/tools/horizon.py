@@ -0,0 +1,126 @@
+import numpy as np
+from tools.raster import sample_band
+from tools.viewshed import CURVATURE_COEFFICIENT, EARTH_DIAMETER, VIEWSHED_MAX_DISTANCE
+
+HORIZON_BIN_SIZE = 0.05
+HORIZON_RINGS = 96
+HORIZON_MIN_RING = 100.0
+
+
+def get_elevation_angles(distances, heights, observer_z):
+    # degrees above the horizontal, lowered by the curvature like the viewshed
+    drop = CURVATURE_COEFFICIENT * distances ** 2 / EARTH_DIAMETER
+    return np.degrees(np.arctan2(heights - drop - observer_z, distances))
+
+
+def compute_horizon(
+    band,
+    transform,
+    nodata,
+    x,
+    y,
+    observer_height=2.0,
+    max_distance=VIEWSHED_MAX_DISTANCE,
+    bin_size=HORIZON_BIN_SIZE,
+    rings=HORIZON_RINGS,
+    chunk=256,
+):
+    # the highest elevation angle seen from x, y in every azimuth bin, and
+    # how far away it is. the same maximum up to each of the ring distances
+    # lets targets in front of the skyline be tested too. None when the
+    # observer is outside the band
+    observer_z = sample_band(band, transform, nodata, [x], [y])[0]
+    if np.isnan(observer_z):
+        return None
+    observer_z += observer_height
+    step = min(abs(transform.a), abs(transform.e))
+    distances = np.arange(1, int(max_distance / step) + 1) * step
+    ring_distances = np.geomspace(HORIZON_MIN_RING, max_distance, rings)
+    ring_index = np.searchsorted(distances, ring_distances, side="right") - 1
+
+    bins = int(round(360 / bin_size))
+    skyline = np.empty(bins, dtype=np.float32)
+    skyline_distance = np.empty(bins, dtype=np.float32)
+    ring_angles = np.empty((bins, rings), dtype=np.float16)
+    for start in range(0, bins, chunk):
+        azimuths = np.radians((np.arange(start, min(start + chunk, bins)) + 0.5) * bin_size)
+        xs = x + np.sin(azimuths)[:, None] * distances
+        ys = y + np.cos(azimuths)[:, None] * distances
+        heights = sample_band(band, transform, nodata, xs, ys, bilinear=True)
+        angles = get_elevation_angles(distances, heights, observer_z)
+        # off the band and nodata never block the view
+        horizon = np.maximum.accumulate(np.nan_to_num(angles, nan=-90.0), axis=1)
+        skyline[start:start + chunk] = horizon[:, -1]
+        skyline_distance[start:start + chunk] = distances[
+            np.argmax(horizon >= horizon[:, -1:], axis=1)]
+        ring_angles[start:start + chunk] = np.where(
+            ring_index >= 0, horizon[:, np.maximum(ring_index, 0)], -90.0)
+    return {
+        "observer": np.array([x, y, observer_z], dtype=np.float64),
+        "bin_size": np.float64(bin_size),
+        "angle": skyline,
+        "distance": skyline_distance,
+        "ring_distances": ring_distances.astype(np.float32),
+        "ring_angles": ring_angles,
+    }
+
+
+def save_horizon(filename, horizon):
+    np.savez_compressed(filename, **horizon)
+    return filename
+
+
+def load_horizon(filename):
+    with np.load(filename) as data:
+        return {key: data[key] for key in data.files}
+
+
+def horizon_visible(horizon, band, transform, nodata, xs, ys, heights, tolerance=0.0):
+    # targets at xs, ys and heights rising above the terrain in front of
+    # them. the rings only hold the terrain up to fixed distances, so the
+    # terrain between the last ring and a target is sampled from band along
+    # its bearing, band being the one the horizon was computed from
+    observer_x, observer_y, observer_z = horizon["observer"]
+    dx = np.asarray(xs, dtype=np.float64) - observer_x
+    dy = np.asarray(ys, dtype=np.float64) - observer_y
+    distances = np.hypot(dx, dy)
+    angles = get_elevation_angles(
+        distances, np.asarray(heights, dtype=np.float64), observer_z)
+    # the terrain within two cells of a target is the target itself
+    step = min(abs(transform.a), abs(transform.e))
+    reach = distances - 2 * step
+
+    bins = horizon["angle"].size
+    azimuth_bin = (
+        np.floor(np.degrees(np.arctan2(dx, dy)) % 360 / horizon["bin_size"])
+        .astype(np.int64) % bins)
+    # the closest terrain is within the first ring, and never blocks
+    ring = np.searchsorted(horizon["ring_distances"], reach, side="right") - 1
+    blocking = np.where(
+        ring >= 0,
+        horizon["ring_angles"][azimuth_bin, np.maximum(ring, 0)].astype(np.float64),
+        -90.0)
+    # beyond the skyline only the skyline itself matters
+    beyond = reach > horizon["distance"][azimuth_bin]
+    blocking = np.where(beyond, horizon["angle"][azimuth_bin], blocking)
+    visible = ~np.isnan(angles) & (angles + tolerance >= blocking)
+
+    check = np.flatnonzero(visible & ~beyond & (reach > 0))
+    if check.size == 0:
+        return visible
+    start = np.where(
+        ring[check] >= 0, horizon["ring_distances"][np.maximum(ring[check], 0)], 0.0)
+    samples = np.arange(1, int(np.ceil((reach[check] - start).max() / step)) + 1) * step
+    sample_distances = start[:, None] + samples
+    fractions = sample_distances / distances[check][:, None]
+    terrain = sample_band(
+        band, transform, nodata,
+        observer_x + dx[check][:, None] * fractions,
+        observer_y + dy[check][:, None] * fractions,
+        bilinear=True)
+    terrain_angles = np.where(
+        sample_distances <= reach[check][:, None],
+        np.nan_to_num(get_elevation_angles(sample_distances, terrain, observer_z), nan=-90.0),
+        -90.0)
+    visible[check] = angles[check] + tolerance >= terrain_angles.max(axis=1)
+    return visible
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from functools import lru_cache
+import gpxpy
+import numpy as np
+from tools.debug import p_i
+from tools.types import Location, Mountain, get_latlng_to_crs
+from tools.workspace import move_file, scratch_workspace
+
+PEAK_INDEX_CELL_SIZE = 5000
+PEAK_INDEX_COLUMNS = (
+    "names", "links", "lats", "lons", "elevations", "xs", "ys", "cells", "starts")
+
+
+@lru_cache(maxsize=64)
+def hash_file(path, size, mtime):
+    # size and mtime only key the memo, the hash is of the content so a
+    # copy or a new upload of the same gpx shares its index
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_peak_index_path(gpx_path, crs, cache_folder):
+    gpx_stat = os.stat(gpx_path)
+    gpx_hash = hash_file(
+        os.path.abspath(gpx_path), gpx_stat.st_size, gpx_stat.st_mtime_ns)
+    return f"{cache_folder}/{gpx_hash[:16]}-{crs}"
+
+
+def get_cells(xs, ys, cell_size):
+    return np.floor(xs / cell_size).astype(np.int64), np.floor(ys / cell_size).astype(np.int64)
+
+
+def build_peak_index(gpx_path, crs, index_path, cell_size=PEAK_INDEX_CELL_SIZE):
+    # every waypoint projected once and sorted into grid cells, so the peaks
+    # of a cell are one slice of the arrays
+    p_i(f"Indexing the peaks in {gpx_path}")
+    with open(gpx_path, "r") as gpx_file:
+        waypoints = gpxpy.parse(gpx_file).waypoints
+    lats = np.array([w.latitude for w in waypoints], dtype=np.float64)
+    lons = np.array([w.longitude for w in waypoints], dtype=np.float64)
+    elevations = np.array(
+        [w.elevation if w.elevation is not None else np.nan for w in waypoints],
+        dtype=np.float64)
+    xs, ys = get_latlng_to_crs(crs).convert_many(lats, lons) if waypoints else (lats, lons)
+    cell_xs, cell_ys = get_cells(xs, ys, cell_size)
+    order = np.lexsort((cell_ys, cell_xs))
+    cells, starts = np.unique(
+        np.stack([cell_xs[order], cell_ys[order]], axis=1), axis=0, return_index=True)
+    columns = {
+        "names": np.array([waypoints[i].name or "" for i in order], dtype=str),
+        "links": np.array([waypoints[i].link or "" for i in order], dtype=str),
+        "lats": lats[order],
+        "lons": lons[order],
+        "elevations": elevations[order],
+        "xs": xs[order],
+        "ys": ys[order],
+        "cells": cells.reshape(-1, 2),
+        "starts": np.append(starts, len(order)),
+    }
+    # one plain .npy per column so lookups memory map them, the metadata
+    # goes last as it marks the index as complete
+    with scratch_workspace() as workspace:
+        tmp_index = f"{workspace}/index"
+        os.mkdir(tmp_index)
+        for key, column in columns.items():
+            np.save(f"{tmp_index}/{key}.npy", column)
+        with open(f"{tmp_index}/index.json", "w") as index_file:
+            json.dump({"cell_size": cell_size, "crs": crs,
+                       "source": os.path.basename(gpx_path)}, index_file)
+        if os.path.exists(f"{index_path}/index.json"):
+            # built by another process in the meantime
+            return index_path
+        shutil.rmtree(index_path, ignore_errors=True)
+        move_file(tmp_index, index_path)
+    return index_path
+
+
+@dataclass(init=False)
+class PeakIndex:
+    path: str
+    crs: int
+    cell_size: float
+    names: any
+    links: any
+    lats: any
+    lons: any
+    elevations: any
+    xs: any
+    ys: any
+    cells: any
+    starts: any
+
+    def __init__(self, path):
+        self.path = path
+        for key in PEAK_INDEX_COLUMNS:
+            setattr(self, key, np.load(f"{path}/{key}.npy", mmap_mode="r"))
+        with open(f"{path}/index.json") as index_file:
+            metadata = json.load(index_file)
+        self.cell_size = metadata["cell_size"]
+        self.crs = metadata["crs"]
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, x, y, radius):
+        # indices of the peaks within radius of x, y, only the cells the
+        # circle touches are looked at
+        if len(self) == 0:
+            return np.array([], dtype=np.int64)
+        min_x, min_y = get_cells(np.float64(x - radius), np.float64(y - radius), self.cell_size)
+        max_x, max_y = get_cells(np.float64(x + radius), np.float64(y + radius), self.cell_size)
+        touched = np.flatnonzero(
+            (self.cells[:, 0] >= min_x) & (self.cells[:, 0] <= max_x)
+            & (self.cells[:, 1] >= min_y) & (self.cells[:, 1] <= max_y))
+        if touched.size == 0:
+            return np.array([], dtype=np.int64)
+        candidates = np.concatenate(
+            [np.arange(self.starts[i], self.starts[i + 1]) for i in touched])
+        near = np.hypot(self.xs[candidates] - x, self.ys[candidates] - y) <= radius
+        return candidates[near]
+
+    def mountains(self, indices):
+        return [
+            Mountain(
+                str(self.names[i]),
+                Location(
+                    float(self.lats[i]),
+                    float(self.lons[i]),
+                    None if np.isnan(self.elevations[i]) else float(self.elevations[i]),
+                ),
+                np.array((self.xs[i], self.ys[i])),
+                link=str(self.links[i]) or None,
+            )
+            for i in indices
+        ]
+
+
+@lru_cache(maxsize=8)
+def load_peak_index(index_path):
+    return PeakIndex(index_path)
+
+
+def open_peak_index(gpx_path, crs, cache_folder="data/cache/peaks"):
+    # parsed once per gpx content and crs, every later lookup in any
+    # process memory maps the columns
+    index_path = get_peak_index_path(gpx_path, crs, cache_folder)
+    if not os.path.exists(f"{index_path}/index.json"):
+        os.makedirs(cache_folder, exist_ok=True)
+        build_peak_index(gpx_path, crs, index_path)
+    return load_peak_index(os.path.abspath(index_path))
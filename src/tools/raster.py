@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.coords import BoundingBox
+from rasterio.errors import WindowError
+from rasterio.transform import rowcol
+from rasterio.windows import Window, from_bounds
+
+
+def get_export_paths(path):
+    return f"{path}.npy", f"{path}.npy.json"
+
+
+def export_raster(path):
+    # raw copy of the band next to the raster, with the metadata lookups
+    # need, so worker processes memory map it instead of decoding their own
+    band_path, metadata_path = get_export_paths(path)
+    stat = os.stat(path)
+    try:
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        if (
+            metadata["size"] == stat.st_size
+            and metadata["mtime"] == stat.st_mtime_ns
+            and os.path.exists(band_path)
+        ):
+            return metadata
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    with rasterio.open(path) as ds_raster:
+        band = ds_raster.read(1)
+        metadata = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "crs": int(ds_raster.crs.to_authority()[1]),
+            "bounds": list(ds_raster.bounds),
+            "transform": list(ds_raster.transform)[:6],
+            "nodata": ds_raster.nodata,
+            "shape": list(band.shape),
+        }
+    valid = drop_nodata(band, metadata["nodata"])
+    metadata["min"] = valid.min().item() if valid.size else None
+    metadata["max"] = valid.max().item() if valid.size else None
+
+    # private names so concurrent exports never expose a partial file,
+    # the metadata goes last as it marks the export as complete
+    suffix = f"{os.getpid()}-{threading.get_ident()}"
+    with open(f"{band_path}.{suffix}", "wb") as band_file:
+        np.save(band_file, band)
+    with open(f"{metadata_path}.{suffix}", "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(f"{band_path}.{suffix}", band_path)
+    os.replace(f"{metadata_path}.{suffix}", metadata_path)
+    return metadata
+
+
+def sample_band(band, transform, nodata, xs, ys, bilinear=False):
+    # one inverse affine for all points, nan off the band and on nodata.
+    # bilinear falls back to the nearest pixel where a neighbour is missing
+    cols, rows = ~transform * (
+        np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+    height, width = band.shape
+    values = np.full(cols.shape, np.nan)
+
+    col, row = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    values[inside] = band[row[inside], col[inside]]
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    if not bilinear:
+        return values
+
+    # pixel values sit at the pixel centres
+    cols, rows = cols - 0.5, rows - 0.5
+    col, row = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+    inside = (col >= 0) & (col < width - 1) & (row >= 0) & (row < height - 1)
+    col, row = col[inside], row[inside]
+    corners = np.stack([
+        band[row, col], band[row, col + 1], band[row + 1, col], band[row + 1, col + 1]
+    ]).astype(np.float64)
+    t_col, t_row = cols[inside] - col, rows[inside] - row
+    interpolated = (
+        (corners[0] * (1 - t_col) + corners[1] * t_col) * (1 - t_row)
+        + (corners[2] * (1 - t_col) + corners[3] * t_col) * t_row
+    )
+    if nodata is not None:
+        interpolated[(corners == nodata).any(axis=0)] = np.nan
+    values[inside] = np.where(
+        np.isnan(interpolated), values[inside], interpolated)
+    return values
+
+
+@dataclass(init=False)
+class RasterAccessor:
+    path: str
+    crs: int
+    bounds: any
+    transform: any
+    nodata: float
+    height: int
+    width: int
+    min: float
+    max: float
+    band: any
+
+    def __init__(self, path):
+        # the band is a read only memory map of the export, shared between
+        # every process looking at the same raster
+        self.path = path
+        metadata = export_raster(path)
+        self.crs = metadata["crs"]
+        self.bounds = BoundingBox(*metadata["bounds"])
+        self.transform = Affine(*metadata["transform"])
+        self.nodata = metadata["nodata"]
+        self.height, self.width = metadata["shape"]
+        self.min = metadata["min"]
+        self.max = metadata["max"]
+        self.band = np.load(get_export_paths(path)[0], mmap_mode="r")
+
+    def index(self, x, y):
+        return rowcol(self.transform, x, y)
+
+    def contains(self, row, col, radius=0):
+        return (
+            radius <= row < self.height - radius
+            and radius <= col < self.width - radius
+        )
+
+    def sample(self, x, y):
+        row, col = self.index(x, y)
+        if not self.contains(row, col):
+            return None
+        return self.band[row, col]
+
+    def sample_many(self, xs, ys, bilinear=False):
+        return sample_band(self.band, self.transform, self.nodata, xs, ys, bilinear)
+
+    def neighbourhood(self, x, y, radius=1):
+        # the (2 * radius + 1) square around the pixel, None at the edges
+        row, col = self.index(x, y)
+        if not self.contains(row, col, radius):
+            return None
+        return self.band[row - radius:row + radius + 1, col - radius:col + radius + 1]
+
+
+def sample_raster(path, xs, ys, bilinear=False, padding=2):
+    # windowed read of just the tiles under the points, for rasters too
+    # large to export like the ingested dem
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if xs.size == 0:
+        return np.full(xs.shape, np.nan)
+    with rasterio.open(path) as ds_raster:
+        window = from_bounds(
+            xs.min(), ys.min(), xs.max(), ys.max(), ds_raster.transform)
+        window = Window(
+            window.col_off - padding,
+            window.row_off - padding,
+            window.width + 2 * padding,
+            window.height + 2 * padding,
+        ).round_offsets().round_lengths()
+        try:
+            window = window.intersection(
+                Window(0, 0, ds_raster.width, ds_raster.height))
+        except WindowError:
+            return np.full(xs.shape, np.nan)
+        band = ds_raster.read(1, window=window)
+        return sample_band(
+            band, ds_raster.window_transform(window), ds_raster.nodata,
+            xs, ys, bilinear)
+
+
+@lru_cache(maxsize=4)
+def load_raster(path, mtime):
+    return RasterAccessor(path)
+
+
+def open_raster(path):
+    # shared per process, a changed file on disk is read again
+    return load_raster(os.path.abspath(path), os.stat(path).st_mtime)
+
+
+def drop_nodata(values, nodata):
+    values = np.asarray(values)
+    if nodata is None:
+        return values
+    return values[values != nodata]
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from tools.debug import p_i
+from tools.heightfield_lod import LOD_MAX_LEVELS
+
+# renders and the coordinate buffers rendered next to them
+CACHED_EXTENSIONS = (".png", ".npz")
+
+
+def get_render_key(dem_file, bounds, coordinates, va, mode, dimensions, backend, lod=False):
+    dem_stat = os.stat(dem_file)
+    parts = [
+        os.path.abspath(dem_file),
+        dem_stat.st_size,
+        int(dem_stat.st_mtime),
+        [round(float(b), 3) for b in bounds],
+        [round(float(c), 7) for c in coordinates],
+        float(va),
+        mode,
+        [int(d) for d in dimensions],
+        backend,
+        # the level of detail height field renders differently than the
+        # full resolution crop
+        {"max_levels": LOD_MAX_LEVELS} if lod else None,
+    ]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def get_cached_path(cache_folder, key, extension=".png"):
+    return f"{cache_folder}/{key}{extension}"
+
+
+def copy_file(src, dst):
+    # copied and not hard linked, the image pipeline writes some of these
+    # files in place and must never change a cache entry through them. goes
+    # through a private name so concurrent jobs never see a partial file
+    tmp_dst = f"{dst}.{os.getpid()}-{threading.get_ident()}"
+    shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def fetch_render(cache_folder, key, out_filename):
+    cached_path = get_cached_path(
+        cache_folder, key, os.path.splitext(out_filename)[1])
+    if not os.path.exists(cached_path):
+        return False
+    # mark as recently used for the lru eviction
+    os.utime(cached_path)
+    copy_file(cached_path, out_filename)
+    p_i(f"Render cache hit for {out_filename}")
+    return True
+
+
+def store_render(cache_folder, key, render_filename, max_size_mb):
+    if not os.path.exists(render_filename):
+        return
+    os.makedirs(cache_folder, exist_ok=True)
+    copy_file(
+        render_filename,
+        get_cached_path(cache_folder, key, os.path.splitext(render_filename)[1]),
+    )
+    evict_renders(cache_folder, max_size_mb * 1024 * 1024)
+
+
+def evict_renders(cache_folder, max_bytes):
+    entries = []
+    for f in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, f)
+        if not f.endswith(CACHED_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        p_i(f"Evicted {path} from render cache")
@@ -3,11 +3,10 @@ import cv2
 import numpy as np
 import pickle
 import rasterio
-import subprocess
-from osgeo import gdal
-from tools.converters import convert_single_coordinate_pair
+from tools.converters import convert_coordinate_pairs
+from tools.dem_crop import read_dem_window
 from tools.file_handling import read_hike_gpx
-from tools.types import LatLngToCrs, TextureBounds
+from tools.types import TextureBounds, get_latlng_to_crs
 from tools.debug import p_i
 
 
@@ -68,24 +67,22 @@ def create_route_texture(dem_file, gpx_path, debugging=False):
     mns, minimums, maximums = read_hike_gpx(gpx_path)
     ds_raster = rasterio.open(dem_file)
     crs = int(ds_raster.crs.to_authority()[1])
-    converter = LatLngToCrs(crs)
+    converter = get_latlng_to_crs(crs)
     lower_left = converter.convert(minimums[0].latitude, minimums[1].longitude)
     upper_right = converter.convert(
         maximums[0].latitude, maximums[1].longitude)
 
     bbox = (
         lower_left.GetX(),
-        upper_right.GetY(),
-        upper_right.GetX(),
         lower_left.GetY(),
+        upper_right.GetX(),
+        upper_right.GetY(),
     )
 
-    gdal.Translate(
-        f"{folder}/{filename}-output_crop_raster.tif", dem_file, projWin=bbox
-    )
-
-    im = cv2.imread(f"{folder}/{filename}-output_crop_raster.tif")
-    h, w, _ = im.shape
+    # only the extent of the route is needed, a mosaic reads just the
+    # tiles under it
+    band, _, _ = read_dem_window(dem_file, bbox)
+    h, w = band.shape
     rs = 1
     if debugging:
         rs = 20
@@ -101,12 +98,9 @@ def create_route_texture(dem_file, gpx_path, debugging=False):
     crs = int(ds_raster.crs.to_authority()[1])
     b = ds_raster.bounds
     bounds = [b.left, b.bottom, b.right, b.top]
-    converter = LatLngToCrs(crs)
-    locs = [
-        convert_single_coordinate_pair(
-            bounds, converter, i.latitude, i.longitude)
-        for i in mns
-    ]
+    converter = get_latlng_to_crs(crs)
+    locs = convert_coordinate_pairs(
+        bounds, converter, [i.latitude for i in mns], [i.longitude for i in mns])
     prev_lat = abs(int(((100.0 * locs[0][0]) / 100) * w))
     prev_lon = h - abs(int(100.0 - ((100.0 * locs[0][1]) / 100.0) * h))
     for i in locs:
@@ -119,18 +113,10 @@ def create_route_texture(dem_file, gpx_path, debugging=False):
     min_lon_p = minimums[1]
     max_lat_p = maximums[0]
     max_lon_p = maximums[1]
-    min_x = convert_single_coordinate_pair(
-        bounds, converter, min_lat_p.latitude, min_lat_p.longitude
-    )
-    min_y = convert_single_coordinate_pair(
-        bounds, converter, min_lon_p.latitude, min_lon_p.longitude
-    )
-    max_x = convert_single_coordinate_pair(
-        bounds, converter, max_lat_p.latitude, max_lat_p.longitude
-    )
-    max_y = convert_single_coordinate_pair(
-        bounds, converter, max_lon_p.latitude, max_lon_p.longitude
-    )
+    extremes = [min_lat_p, min_lon_p, max_lat_p, max_lon_p]
+    min_x, min_y, max_x, max_y = convert_coordinate_pairs(
+        bounds, converter,
+        [i.latitude for i in extremes], [i.longitude for i in extremes])
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     _, thresh = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
     contours, _ = cv2.findContours(
@@ -156,7 +142,4 @@ def create_route_texture(dem_file, gpx_path, debugging=False):
     with open(texture_bounds_path, "wb") as f:
         pickle.dump(tex_bounds, f)
 
-    subprocess.call(
-        ["rm", "-r", f"{folder}/{filename}-output_crop_raster.tif"])
-
     return [im_path, tex_bounds]
@@ -1,7 +1,12 @@
 import operator
+import threading
 from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
 from osgeo import ogr, osr
 from geopy import distance
+from rasterio.crs import CRS
+from rasterio.warp import transform as warp_transform
 
 
 @dataclass
@@ -140,6 +145,11 @@ class ImageData:
     transform_matrix: any = None
     place_name: str = ""
     place_elevation: float = None
+    crop_render_path: str = None
+    render_bbox: list = None
+    crop_scale: float = None
+    coordinates_path: str = None
+    horizon_path: str = None
 
     def __init__(self, path):
         self.path = path
@@ -148,8 +158,11 @@ class ImageData:
         self.render_path = self.path.replace(
             f"{self.filename}.jpg", f"{self.filename}-render.png"
         )
-        self.gradient_path = self.path.replace(
-            f"{self.filename}.jpg", f"{self.filename}-gradient.png"
+        self.coordinates_path = self.path.replace(
+            f"{self.filename}.jpg", f"{self.filename}-coordinates.npz"
+        )
+        self.horizon_path = self.path.replace(
+            f"{self.filename}.jpg", f"{self.filename}-horizon.npz"
         )
         self.overlay_path = self.path.replace(
             f"{self.filename}.jpg", f"{self.filename}-overlay.jpg"
@@ -163,6 +176,9 @@ class ImageData:
         self.warped_panorama_path = self.path.replace(
             f"{self.filename}.jpg", f"{self.filename}-warped.jpg"
         )
+        self.crop_render_path = self.path.replace(
+            f"{self.filename}.jpg", f"{self.filename}-render-crop.png"
+        )
 
         self.hotspots = {}
         self.all_images = set()
@@ -195,6 +211,13 @@ class CrsToLatLng:
             latitude=float(point.GetX()), longitude=float(point.GetY()), elevation=ele
         )
 
+    def convert_many(self, xs, ys):
+        # every point in one call, latitude and longitude arrays
+        lons, lats = warp_transform(
+            get_warp_crs(self.crs), get_warp_crs(self.latlng_epsg),
+            np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        return np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+
 
 @dataclass(init=False)
 class LatLngToCrs:
@@ -217,6 +240,13 @@ class LatLngToCrs:
         point.Transform(self.transform)
         return point
 
+    def convert_many(self, lats, lons):
+        # every point in one call, x (easting) and y (northing) arrays
+        xs, ys = warp_transform(
+            get_warp_crs(self.latlng_epsg), get_warp_crs(self.crs),
+            np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        return np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+
 
 @dataclass
 class Distance:
@@ -226,3 +256,28 @@ class Distance:
         return self.generator.great_circle(
             (loc1.latitude, loc1.longitude), (loc2.latitude, loc2.longitude)
         ).m
+
+
+@lru_cache(maxsize=None)
+def get_warp_crs(epsg):
+    return CRS.from_epsg(epsg)
+
+
+# coordinate transformations are not thread safe, so converters are shared
+# per epsg code within a thread
+@lru_cache(maxsize=64)
+def load_latlng_to_crs(crs, thread):
+    return LatLngToCrs(crs)
+
+
+@lru_cache(maxsize=64)
+def load_crs_to_latlng(crs, thread):
+    return CrsToLatLng(crs)
+
+
+def get_latlng_to_crs(crs):
+    return load_latlng_to_crs(int(crs), threading.get_ident())
+
+
+def get_crs_to_latlng(crs):
+    return load_crs_to_latlng(int(crs), threading.get_ident())
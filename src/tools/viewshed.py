@@ -0,0 +1,186 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.transform import rowcol
+from tools.workspace import move_file, scratch_workspace
+
+# same defaults as gdal_viewshed
+EARTH_DIAMETER = 12742000.0
+CURVATURE_COEFFICIENT = 0.85714
+VIEWSHED_MAX_DISTANCE = 20000
+
+
+def get_perimeter(col_min, col_max, row_min, row_max):
+    # cells on the edge of the box, the rays towards them pass every cell
+    cols = np.arange(col_min, col_max + 1)
+    rows = np.arange(row_min + 1, row_max)
+    return (
+        np.concatenate([cols, cols, np.full(rows.size, col_min), np.full(rows.size, col_max)]),
+        np.concatenate([np.full(cols.size, row_min), np.full(cols.size, row_max), rows, rows]),
+    )
+
+
+def compute_viewshed(
+    band,
+    transform,
+    nodata,
+    x,
+    y,
+    observer_height=2.0,
+    target_height=0.0,
+    max_distance=VIEWSHED_MAX_DISTANCE,
+    curvature_coefficient=CURVATURE_COEFFICIENT,
+    chunk=256,
+):
+    # boolean grid of the cells visible from x, y in the crs of the band,
+    # observer_height above the terrain. one ray per cell on the edge of the
+    # max_distance box, a cell is visible when it rises above everything
+    # between it and the observer on any ray through it. None when the
+    # observer is outside the band
+    height, width = band.shape
+    observer_col, observer_row = (int(v) for v in np.floor(~transform * (x, y)))
+    if not (0 <= observer_col < width and 0 <= observer_row < height):
+        return None
+    heights = np.asarray(band, dtype=np.float64)
+    if nodata is not None:
+        # nodata neither blocks the view nor is seen
+        heights = np.where(heights == nodata, -np.inf, heights)
+    observer_z = heights[observer_row, observer_col] + observer_height
+    cell_x, cell_y = abs(transform.a), abs(transform.e)
+
+    reach_cols = int(np.ceil(max_distance / cell_x))
+    reach_rows = int(np.ceil(max_distance / cell_y))
+    target_cols, target_rows = get_perimeter(
+        max(observer_col - reach_cols, 0),
+        min(observer_col + reach_cols, width - 1),
+        max(observer_row - reach_rows, 0),
+        min(observer_row + reach_rows, height - 1),
+    )
+
+    visible = np.zeros(band.shape, dtype=bool)
+    visible[observer_row, observer_col] = True
+    for start in range(0, target_cols.size, chunk):
+        d_col = (target_cols[start:start + chunk] - observer_col)[:, None]
+        d_row = (target_rows[start:start + chunk] - observer_row)[:, None]
+        steps = np.maximum(np.abs(d_col), np.abs(d_row))
+        fraction = np.arange(1, steps.max() + 1) / np.maximum(steps, 1)
+        on_ray = fraction <= 1
+        cols = np.minimum(observer_col + d_col * fraction, width - 1)
+        rows = np.minimum(observer_row + d_row * fraction, height - 1)
+        cols, rows = np.where(on_ray, cols, observer_col), np.where(on_ray, rows, observer_row)
+
+        # the terrain between cells blocks, interpolated across the ray
+        col_0 = np.minimum(np.floor(cols).astype(np.int64), width - 2)
+        row_0 = np.minimum(np.floor(rows).astype(np.int64), height - 2)
+        t_col, t_row = cols - col_0, rows - row_0
+        terrain = (
+            (heights[row_0, col_0] * (1 - t_col) + heights[row_0, col_0 + 1] * t_col) * (1 - t_row)
+            + (heights[row_0 + 1, col_0] * (1 - t_col) + heights[row_0 + 1, col_0 + 1] * t_col) * t_row
+        )
+        distance = np.hypot((cols - observer_col) * cell_x, (rows - observer_row) * cell_y)
+        drop = curvature_coefficient * distance ** 2 / EARTH_DIAMETER
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(on_ray, (terrain - drop - observer_z) / distance, -np.inf)
+        horizon = np.maximum.accumulate(np.nan_to_num(slope, nan=-np.inf), axis=1)
+        horizon = np.concatenate(
+            [np.full((horizon.shape[0], 1), -np.inf), horizon[:, :-1]], axis=1)
+
+        # while the target is the cell the ray passes through
+        target_col = np.rint(cols).astype(np.int64)
+        target_row = np.rint(rows).astype(np.int64)
+        target_distance = np.hypot(
+            (target_col - observer_col) * cell_x, (target_row - observer_row) * cell_y)
+        target_drop = curvature_coefficient * target_distance ** 2 / EARTH_DIAMETER
+        with np.errstate(divide="ignore", invalid="ignore"):
+            target_slope = (
+                heights[target_row, target_col] + target_height - target_drop - observer_z
+            ) / target_distance
+        seen = on_ray & (target_distance <= max_distance) & (target_slope >= horizon)
+        visible[target_row[seen], target_col[seen]] = True
+    return visible
+
+
+def save_viewshed(filename, visible, transform, crs):
+    # bit packed, a byte holds eight cells, and compressed on top of that
+    with scratch_workspace() as workspace:
+        tmp_filename = f"{workspace}/viewshed.npz"
+        np.savez_compressed(
+            tmp_filename,
+            bits=np.packbits(visible, axis=None),
+            shape=np.array(visible.shape),
+            transform=np.array(list(transform)[:6]),
+            crs=np.array(crs),
+        )
+        move_file(tmp_filename, filename)
+    return filename
+
+
+def get_viewshed_path(folder):
+    # viewsheds from before the packed store are geotiffs
+    for name in ("viewshed.npz", "viewshed.tif"):
+        if os.path.exists(f"{folder}/{name}"):
+            return f"{folder}/{name}"
+    return None
+
+
+@dataclass(init=False)
+class PackedViewshed:
+    path: str
+    crs: int
+    transform: any
+    height: int
+    width: int
+    bits: any
+
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".tif"):
+            with rasterio.open(path) as ds_viewshed:
+                visible = ds_viewshed.read(1) == 255
+                self.crs = int(ds_viewshed.crs.to_authority()[1])
+                self.transform = ds_viewshed.transform
+            self.height, self.width = visible.shape
+            self.bits = np.packbits(visible, axis=None)
+            return
+        with np.load(path) as data:
+            self.bits = data["bits"]
+            self.height, self.width = (int(v) for v in data["shape"])
+            self.transform = Affine(*data["transform"])
+            self.crs = int(data["crs"])
+
+    def index(self, x, y):
+        return rowcol(self.transform, x, y)
+
+    def visible_cells(self, rows, cols):
+        # membership of every cell at once, False off the viewshed
+        inside = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        cells = np.where(inside, rows * self.width + cols, 0)
+        return inside & ((self.bits[cells >> 3] >> (7 - (cells & 7))) & 1).astype(bool)
+
+    def visible_many(self, xs, ys):
+        cols, rows = ~self.transform * (
+            np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        return self.visible_cells(
+            np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64))
+
+    def sample(self, x, y):
+        # 255 and 0 like the viewshed geotiff, None off the viewshed
+        row, col = self.index(x, y)
+        if not (0 <= row < self.height and 0 <= col < self.width):
+            return None
+        cell = row * self.width + col
+        return 255 if (self.bits[cell >> 3] >> (7 - (cell & 7))) & 1 else 0
+
+
+@lru_cache(maxsize=16)
+def load_viewshed(path, mtime):
+    return PackedViewshed(path)
+
+
+def open_viewshed(path):
+    # shared per process like tools.raster.open_raster, a viewshed is decoded
+    # once per image and not once per lookup
+    return load_viewshed(os.path.abspath(path), os.stat(path).st_mtime)
@@ -0,0 +1,23 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def scratch_workspace(prefix="panovis-"):
+    # private scratch folder for one stage of a job, removed when done so
+    # concurrent jobs never share intermediate files
+    folder = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield folder
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def move_file(src, dst):
+    # scratch folders may live on another filesystem than the images
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.move(src, dst)